@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Compare the time of expanding templates nested at increasing depths, when
+the text is scanned once by parse_braces() and when each part is scanned
+again by findMatchingBraces(), as formerly.
+
+    python -m benchmarks.bench_braces [--depths 100,200,400,800]
+"""
+
+import argparse
+import sys
+from timeit import default_timer
+
+from wikiextractor import extract
+from wikiextractor.extract import Extractor
+
+
+def nested(depth):
+    """A page with templates and parser functions nested :param depth: times."""
+    text = 'x'
+    for i in range(depth):
+        if i % 2:
+            text = '{{Wrap|%s|[[link|%d]]}}' % (text, i)
+        else:
+            text = '{{#if: yes | %s | no }}' % text
+    return 'Some text ' + text + ' more text.'
+
+
+def measure(text, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        extractor = Extractor('1', '1', '', '', 'Page', [])
+        extractor.set_magic_words()
+        extract.expansionCache.clear()
+        start = default_timer()
+        extractor.expandTemplates(text)
+        best = min(best, default_timer() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depths", default='100,200,400,800',
+                        help="comma separated nesting depths")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(100000)   # expansion recurses at each level
+    Extractor.templatePrefix = 'Template:'
+    extract.templates = {'Template:Wrap': '{{{1}}}'}
+    parse_braces = extract.parse_braces
+    print('%8s %12s %12s' % ('depth', 'rescan', 'parse once'))
+    for depth in map(int, args.depths.split(',')):
+        text = nested(depth)
+        extract.parse_braces = lambda text: None
+        rescan = measure(text, args.repeat)
+        extract.parse_braces = parse_braces
+        once = measure(text, args.repeat)
+        print('%8d %11.3fs %11.3fs' % (depth, rescan, once))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Time the functions that assemble a page from its pieces, on synthetic
+pages of increasing size, to check that their time grows linearly: the
+time per MB should stay about the same.
+
+    python -m benchmarks.bench_linear [--sizes 1,2,5,10,20,50]
+"""
+
+import argparse
+from timeit import default_timer
+
+from wikiextractor import extract
+from wikiextractor.extract import Extractor
+
+paragraph = ("The [[Main Page|main page]]s of the [http://example.org wiki] list "
+             "<math>x_%d</math> and <code>f(%d)</code>, <ref>a note</ref>{{!}} "
+             "&amp;nbsp;with '''bold''' and ''italic'' text.<!-- comment --><br/>\n")
+
+
+def page(size):
+    """A page of about :param size: MB."""
+    count = size * 1024 * 1024 // len(paragraph)
+    return ''.join(paragraph % (i, i) for i in range(count))
+
+
+def run(name, text):
+    if name == 'dropSpans':
+        spans = [(m.start(), m.end()) for m in extract.comment.finditer(text)]
+        extract.dropSpans(spans, text)
+    elif name == 'replaceExternalLinks':
+        extract.replaceExternalLinks(text)
+    elif name == 'replaceInternalLinks':
+        extract.replaceInternalLinks(text, [])
+    elif name == 'splitParts':
+        extract.splitParts(text.replace('{{!}}', '{{!}}|'))
+    elif name == 'placeholders':
+        for pattern, placeholder in extract.placeholder_tag_patterns:
+            extract.replacePlaceholders(pattern, placeholder, text)
+    elif name == 'expandTemplates':
+        Extractor('1', '1', '', '', 'Page', []).expandTemplates(text)
+    else:
+        extract.clean(Extractor('1', '1', '', '', 'Page', []), text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default='1,2,5,10,20,50',
+                        help="comma separated page sizes, in MB")
+    parser.add_argument("--functions", default='dropSpans,replaceExternalLinks,replaceInternalLinks,'
+                        'splitParts,placeholders,expandTemplates,clean',
+                        help="comma separated functions to time")
+    args = parser.parse_args()
+
+    Extractor.templatePrefix = 'Template:'
+    extract.templates = {'Template:!': '|'}
+    sizes = list(map(int, args.sizes.split(',')))
+    print('%-22s' % 'function' + ''.join('%12s' % ('%d MB' % size) for size in sizes) + '   (s/MB)')
+    pages = {size: page(size) for size in sizes}
+    for name in args.functions.split(','):
+        times = []
+        for size in sizes:
+            start = default_timer()
+            run(name, pages[size])
+            times.append((default_timer() - start) / size)
+        print('%-22s' % name + ''.join('%12.3f' % t for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Compare the speed of splitting a dump into pages with the per-line tagRE
+loop formerly used by the readers and with wikiextractor.tokenizer.
+
+    python -m benchmarks.bench_tokenizer [dump] [--pages N]
+
+Without a dump, a synthetic one is generated.
+"""
+
+import argparse
+import io
+from timeit import default_timer
+
+from wikiextractor.tokenizer import iter_pages, tagRE
+from wikiextractor.WikiExtractor import decode_open
+
+
+def regex_pages(text):
+    """The former reader loop of collect_pages()."""
+    page = []
+    id = revid = timestamp = title = ''
+    inText = False
+    for line in text:
+        if '<' not in line:
+            if inText:
+                page.append(line)
+            continue
+        m = tagRE.search(line)
+        if not m:
+            continue
+        tag = m.group(2)
+        if tag == 'page':
+            page = []
+        elif tag == 'id' and not id:
+            id = m.group(3)
+        elif tag == 'id' and id and not revid:
+            revid = m.group(3)
+        elif tag == 'timestamp':
+            timestamp = m.group(3)
+        elif tag == 'title':
+            title = m.group(3)
+        elif tag == 'text':
+            inText = True
+            page.append(m.group(3))
+            if m.lastindex == 4:
+                inText = False
+        elif tag == '/text':
+            if m.group(1):
+                page.append(m.group(1))
+            inText = False
+        elif tag == '/page':
+            yield id, revid, timestamp, title, page
+            id = revid = timestamp = title = ''
+            page = []
+            inText = False
+        elif inText:
+            page.append(line)
+
+
+def sample_dump(pages):
+    body = 'Some text with a [[link]] and a {{template|x}}.\n' * 20
+    out = ['<mediawiki>\n']
+    for i in range(pages):
+        out.append('''  <page>
+    <title>Page %d</title>
+    <ns>0</ns>
+    <id>%d</id>
+    <revision>
+      <id>%d</id>
+      <parentid>1</parentid>
+      <timestamp>2024-01-01T00:00:00Z</timestamp>
+      <contributor>
+        <username>User</username>
+        <id>7</id>
+      </contributor>
+      <comment>edit</comment>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="%d" xml:space="preserve">%s</text>
+      <sha1>abc</sha1>
+    </revision>
+  </page>
+''' % (i, i, i + 1000, len(body), body))
+    out.append('</mediawiki>\n')
+    return ''.join(out)
+
+
+def measure(name, reader, data, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = default_timer()
+        count = sum(1 for _ in reader(io.StringIO(data)))
+        best = min(best, default_timer() - start)
+    print('%-10s %8d pages %8.3fs %10.0f pages/s' % (name, count, best, count / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dump", nargs='?', help="XML wiki dump file")
+    parser.add_argument("--pages", type=int, default=20000,
+                        help="pages of the synthetic dump")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.dump:
+        with decode_open(args.dump) as file:
+            data = file.read()
+    else:
+        data = sample_dump(args.pages)
+
+    measure('tagRE', regex_pages, data, args.repeat)
+    measure('tokenizer', iter_pages, data, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
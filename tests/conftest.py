@@ -0,0 +1,63 @@
+import filecmp
+import os
+from typing import Callable, Optional
+
+import pytest
+
+header = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/" version="0.11" xml:lang="en">
+  <siteinfo>
+    <base>https://test.wiki/wiki/Main_Page</base>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="10" case="first-letter">Template</namespace>
+    </namespaces>
+  </siteinfo>
+'''
+
+page = '''  <page>
+    <title>%s</title>
+    <ns>%d</ns>
+    <id>%d</id>
+    <revision>
+      <id>%d</id>
+      <timestamp>2024-01-01T00:00:00Z</timestamp>
+      %s
+    </revision>
+  </page>
+'''
+
+
+@pytest.fixture
+def xml_header() -> str:
+    """
+    The start of a dump, up to its pages, with the main and the template
+    namespaces.
+    """
+    return header
+
+
+@pytest.fixture
+def xml_page() -> Callable[..., str]:
+    """
+    :return: a function returning the XML of a page of a dump, from its
+        title, id, revision id, text, or None for an empty one, and namespace.
+    """
+    def xml_page(title: str, id: int, revid: int, text: Optional[str], ns: int = 0) -> str:
+        if text is None:
+            element = '<text bytes="0" />'
+        else:
+            element = '<text bytes="%d" xml:space="preserve">%s</text>' % (len(text), text)
+        return page % (title, ns, id, revid, element)
+    return xml_page
+
+
+@pytest.fixture
+def same_trees() -> Callable[[str, str], bool]:
+    """
+    :return: a function telling whether two directories hold the same files.
+    """
+    def same_trees(a: str, b: str) -> bool:
+        cmp = filecmp.dircmp(a, b)
+        return not cmp.left_only and not cmp.right_only and not cmp.diff_files and \
+            all(same_trees(os.path.join(a, d), os.path.join(b, d)) for d in cmp.common_dirs)
+    return same_trees
@@ -0,0 +1,347 @@
+import logging
+import marshal
+import random
+from itertools import chain
+from typing import Any
+
+import pytest
+
+from wikiextractor import extract
+from wikiextractor.extract import Extractor
+from wikiextractor.templatestore import TemplateCache
+
+
+@pytest.fixture
+def doubling(monkeypatch: pytest.MonkeyPatch) -> dict[str, str]:
+    """
+    Template:D0 expands to 'x', Template:Dn to two copies of Template:Dn-1.
+    :return: the templates, where tests may add others.
+    """
+    templates = {'Template:D0': 'x'}
+    for n in range(1, 25):
+        templates['Template:D%d' % n] = '{{D%d}}{{D%d}}' % (n - 1, n - 1)
+    monkeypatch.setattr(extract, 'templates', templates)
+    monkeypatch.setattr(extract, 'templateCache', {})
+    monkeypatch.setattr(extract, 'resolvedTitles', {})
+    # expanded every time, as templates that depend on the page
+    monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(0))
+    monkeypatch.setattr(Extractor, 'templatePrefix', 'Template:')
+    return templates
+
+
+def expand(text: str) -> str:
+    extractor = Extractor('1', '2', '', 'http://w', 'Page', [])
+    return ''.join(extractor.clean_text(text))
+
+
+def test_within_budget(doubling: dict[str, str]) -> None:
+    assert expand('a {{D3}} b') == 'a xxxxxxxx b'
+
+
+@pytest.mark.parametrize('budget, value, template', [
+    ('maxExpansionNodes', 1000, 'D12'),
+    ('maxIncludeSize', 1000, 'D12'),
+    ('expansionTimeout', 0.01, 'D24'),
+])
+def test_budget_exceeded(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch, budget: str, value: float,
+                         template: str) -> None:
+    monkeypatch.setattr(Extractor, budget, value)
+    # templates are dropped from the whole page
+    assert expand('a {{D3}} b {{%s}} c' % template) == 'a b c'
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_define_template(monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture, lazy: bool) -> None:
+    monkeypatch.setattr(extract, 'templates', {})
+    monkeypatch.setattr(extract, 'rawTemplates', {})
+    monkeypatch.setattr(extract, 'templateCache', {})
+    monkeypatch.setattr(extract, 'resolvedTitles', {})
+    # expanded every time, as templates that depend on the page
+    monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(0))
+    monkeypatch.setattr(Extractor, 'templatePrefix', 'Template:')
+    extract.define_template('Template:Greet', [
+        '&lt;noinclude&gt;Documentation&lt;/noinclude&gt;Hello &lt;!-- comment --&gt;{{{1}}}\n'], lazy)
+    assert bool(extract.rawTemplates) == lazy
+    assert expand('{{Greet|world}}') == 'Hello world'
+    with caplog.at_level(logging.WARNING):
+        extract.define_template('Template:Greet', ['Hi {{{1}}}'], lazy)
+    assert 'Redefining: Template:Greet' in caplog.text
+
+
+def test_use_templates(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    for name in ('templates', 'redirects', 'rawTemplates'):
+        monkeypatch.setattr(extract, name, {})
+    monkeypatch.setattr(extract, 'templateCache', {})
+    monkeypatch.setattr(extract, 'resolvedTitles', {})
+    monkeypatch.setattr(Extractor, 'templatePrefix', 'Template:')
+    extract.define_template('Template:Greet', ['Hello {{{1}}}<noinclude>doc</noinclude>'], lazy=True)
+    filename = str(tmp_path / 'templates')
+    extract.save_templates(filename, {})
+    cache = TemplateCache(filename)
+    extract.use_templates(cache)
+    # not left to be copied by processes
+    assert extract.rawTemplates == {}
+    assert expand('{{Greet|world}}') == 'Hello world'
+    cache.close()
+
+
+def test_template_dump() -> None:
+    body = 'a {{{1|{{{x|}}}}}} b {{{2}}} {{f|{{{3|d}}}}}'
+    template = extract.Template.parse(body)
+    loaded = extract.Template.load(marshal.loads(marshal.dumps(template.dump())))
+    assert str(loaded) == str(template)
+    assert [type(x) for x in loaded] == [type(x) for x in template]
+    assert loaded[3].default is None and loaded[1].default is not None
+
+
+def test_parse_cache(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    filename = str(tmp_path / 'parsed')
+    monkeypatch.setattr(extract, 'parsedTemplates', {})
+    for run in range(2):
+        monkeypatch.setattr(extract, 'templateCache', {})
+        extract.open_parse_cache(filename, str(tmp_path))
+        if run:
+            # templates come from the cache
+            monkeypatch.setattr(extract.Template, 'parse', None)
+        assert expand('a {{D3}} b') == 'a xxxxxxxx b'
+        assert extract.update_parse_cache(filename) == (0 if run else 4)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['parsed']
+
+
+def test_lru_cache() -> None:
+    cache = extract.LRUCache(2)
+    a, b, c = (extract.Template.parse(x) for x in 'abc')
+    cache['a'] = a
+    cache['b'] = b
+    assert cache.get('a') is a          # 'b' is now the least recently used
+    cache['c'] = c
+    assert 'b' not in cache and cache.get('b') is None
+    assert cache.get('c') is c and len(cache) == 2
+    assert cache.stats(reset=True) == {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2}
+    assert cache.stats()['hits'] == 0
+
+
+def test_expansion_cache(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(100))
+    doubling['Template:P'] = '{{D1}} {{PAGENAME}}'
+    # each of D3, D2, D1 and D0 is expanded once
+    assert expand('{{D3}}') == 'xxxxxxxx'
+    assert extract.expansionCache.stats(reset=True)['misses'] == 4
+    assert expand('{{D3}}') == 'xxxxxxxx'
+    assert extract.expansionCache.stats()['hits'] == 1
+    # depends on the page, as the templates including it
+    for title in ('One', 'Two'):
+        extractor = Extractor('1', '2', '', 'http://w', title, [])
+        assert ''.join(extractor.clean_text('{{D1}}{{P}}')) == 'xxxx %s' % title
+    assert ('Template:P', False) not in extract.expansionCache
+
+
+def test_fold_constant_templates(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    monkeypatch.setattr(extract, 'templates', {
+        'Template:!': '|', 'Template:Flag': '[[File:{{!}}]]', 'Template:Arg': '{{{1}}}',
+        'Template:Here': '{{PAGENAME}}', 'Template:Wrap': '<{{Here}}>'})
+    monkeypatch.setattr(extract, 'rawTemplates', {'Template:Lazy': '<noinclude>doc</noinclude>{{Flag}}'})
+    monkeypatch.setattr(extract, 'foldedTemplates', {})
+    monkeypatch.setattr(extract, 'resolvedTitles', {})
+    monkeypatch.setattr(Extractor, 'templatePrefix', 'Template:')
+    assert extract.fold_constant_templates(str(tmp_path)) == 3
+    assert dict(extract.foldedTemplates) == {
+        'Template:!': '0 1\n|', 'Template:Flag': '1 1\n[[File:|]]', 'Template:Lazy': '2 2\n[[File:|]]'}
+    extractor = Extractor('1', '2', '', 'http://w', 'Page', [])
+    extractor.set_magic_words()
+    assert extractor.expandTemplates('{{Lazy}} {{Wrap}} {{Arg|x}}') == '[[File:|]] <Page> x'
+
+
+def test_folded_template_budgets(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    templates = {title: doubling[title] for title in ('Template:D%d' % n for n in range(5))}
+    templates['Template:Wrap'] = '{{D3}}'
+    templates['Template:Wrap2'] = '{{Wrap}}'
+    monkeypatch.setattr(extract, 'templates', templates)
+    monkeypatch.setattr(extract, 'rawTemplates', {})
+    monkeypatch.setattr(extract, 'foldedTemplates', {})
+    monkeypatch.setattr(extract, 'templateCache', extract.LRUCache(100))
+    pages = ['{{D3}}', '{{Wrap}}', '{{Wrap2}}', '{{Wrap}}{{D3}}', '{{D4}}{{D3}}']
+    assert extract.fold_constant_templates(str(tmp_path)) == 7
+    monkeypatch.setattr(Extractor, 'maxTemplateRecursionLevels', 6)
+    monkeypatch.setattr(Extractor, 'maxExpansionNodes', 40)
+    # the same as when expanding them
+    assert [expand(text) for text in pages] == ['xxxxxxxx', 'xxxxxxxx', '', 'xxxxxxxx' * 2, '']
+
+
+def test_resolve_redirects(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(extract, 'redirects', {
+        'Template:R1': 'Template:R2', 'Template:R2': 'Template:D1',
+        'Template:C1': 'Template:C2', 'Template:C2': 'Template:C1'})
+    assert extract.resolve_redirects() == 2
+    assert extract.redirects == {'Template:R1': 'Template:D1', 'Template:R2': 'Template:D1'}
+    assert expand('{{R1}} {{C1}} {{Missing}} {{R1}}') == 'xx xx'
+    assert extract.resolvedTitles['R1'] == ('Template:D1', None)
+    assert extract.resolvedTitles['Missing'] == ('', None)
+
+
+def random_wikitext(rng: random.Random, depth: int = 0) -> str:
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        r = rng.random()
+        if depth < 4 and r < 0.3:
+            name = rng.choice(['D1', 'P', '#if:', '#if: x', '#switch: a', 'Missing', 'subst:D0'])
+            out.append('{{%s%s}}' % (name, ''.join('|' + random_wikitext(rng, depth + 1)
+                                                   for _ in range(rng.randint(0, 3)))))
+        elif depth < 4 and r < 0.35:
+            out.append('{{{%s}}}' % random_wikitext(rng, depth + 1))
+        elif depth < 4 and r < 0.45:
+            out.append('[[%s|%s]]' % (random_wikitext(rng, depth + 1), random_wikitext(rng, depth + 1)))
+        else:
+            out.append(rng.choice(['a', ' ', '|', '=', 'a=b', '{', '}', '[', ']', '[[', ']]', '}}']))
+    return ''.join(out)
+
+
+def check_braces(text: str, start: int, end: int, nodes: list[extract.BraceNode]) -> None:
+    # as found scanning text[start:end] again
+    span = text[start:end]
+    assert [(n.start - start, n.end - start) for n in nodes] == list(extract.findMatchingBraces(span, 2))
+    for node in nodes:
+        if node.braces == 2:
+            parts = node.parts()
+            assert [text[s:e] for s, e, _ in parts] == extract.splitParts(text[node.start + 2:node.end - 2])
+            for s, e, children in parts:
+                check_braces(text, s, e, children)
+
+
+def test_parse_braces(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    doubling['Template:P'] = '{{#switch:{{{1}}}|a=[[{{D1}}|{{{2|}}}]]|#default={{{1}}}}}'
+    rng = random.Random(1)
+    parsed = 0
+    for _ in range(2000):
+        text = random_wikitext(rng)
+        nodes = extract.parse_braces(text)
+        expansion = expand(text)
+        if nodes is not None:
+            parsed += 1
+            check_braces(text, 0, len(text), nodes)
+        with monkeypatch.context() as m:
+            m.setattr(extract, 'parse_braces', lambda text: None)
+            assert expand(text) == expansion
+    assert parsed > 1000
+    assert extract.parse_braces('{{a|b}}}') is not None
+    assert extract.parse_braces('{{a|b}') is None
+    assert extract.parse_braces('{{{{a}}}}') is None
+
+
+def test_drop_elements(monkeypatch: pytest.MonkeyPatch) -> None:
+    tags = ['div', 'ref', 'references', 'small', 'tr', 'table']
+    pieces = ['<div class="a">', '</div>', '<DIV>', '< div>', '</ div>', '<ref name=a>', '</ref>',
+              '<references/>', '<references>', '</references>', '<small>', '</small>', '<tr>', '</tr>',
+              '<table>', '</table>', '<br/>', 'a', ' ', '\n', '<', '>', '/div>', '<div', 'ref>']
+    rng = random.Random(1)
+    single = 0
+    for _ in range(5000):
+        text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 20)))
+        sequential = text
+        for tag in tags:
+            sequential = extract.dropNested(sequential, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        with monkeypatch.context() as m:
+            calls = []
+
+            def dropNested(*args: Any) -> str:
+                calls.append(args)
+                return sequential
+            m.setattr(extract, 'dropNested', dropNested)
+            assert extract.dropElements(text, tags) == sequential
+        single += not calls
+    assert single > 2000
+
+
+def test_tag_spans() -> None:
+    def scanned(text: str) -> list[tuple[int, int]]:
+        # as found by scanning text for each pattern in turn
+        patterns = [extract.comment, *extract.selfClosing_tag_patterns,
+                    *chain.from_iterable(extract.ignored_tag_patterns)]
+        return sorted(set(m.span() for pattern in patterns for m in pattern.finditer(text)))
+
+    pieces = ['<!--', '-->', '<br/>', '< br />', '<ref name=x/>', '<ref>', '</ref>', '<b>', '</b>', '</ b>',
+              '<B>', '<span class="a">', '</span >', '<a href=x>', '</a>', '<nowiki/>', '<nowiki>', '<bb>',
+              '<ſpan>', '<', '>', '/', ' ', '\n', 'a']
+    rng = random.Random(1)
+    try:
+        for i in range(3000):
+            if i == 1000:
+                extract.ignoreTag('a')
+            elif i == 2000:
+                extract.resetIgnoredTags()
+                extract.ignoreTag('span')
+                extract.ignoreTag('ſpan')
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 20)))
+            assert sorted(set(extract.tagSpans(text))) == scanned(text)
+    finally:
+        extract.resetIgnoredTags()
+        for tag in extract.ignoredTags:
+            extract.ignoreTag(tag)
+
+
+def test_skipped_stages(monkeypatch: pytest.MonkeyPatch) -> None:
+    extractor = Extractor('1', '1', '', '', 'Page', [])
+    texts = ['Plain text.', "Some ''italic'' and \"\"quoted\"\" text.", 'A [[link|label]]s and [http://a.org b].',
+             'An &amp;lt;b&amp;gt; tag, &lt;math&gt;x&lt;/math&gt; and <math>y</math>.', '{|\n|cell\n|}\n__NOTOC__ x']
+    extract.stage_stats(reset=True)
+    cleaned = [extract.clean(extractor, text) for text in texts]
+    stats = extract.stage_stats(reset=True)
+    assert stats['pages'] == len(texts)
+    assert stats['tables'] == len(texts) - 1
+    assert stats['internal links'] == len(texts) - 1
+    monkeypatch.setattr(extract, 'run_stage', lambda stage, text: True)
+    assert [extract.clean(extractor, text) for text in texts] == cleaned
+    assert extract.stage_stats(reset=True) == {'pages': len(texts)}
+
+
+def test_replace_placeholders() -> None:
+    pattern, placeholder = extract.placeholder_tag_patterns[0]
+    text = 'a <math>x</math> b <math>y</math> c <math>x</math> d <math>z</math>'
+    assert extract.replacePlaceholders(pattern, placeholder, text) == \
+        'a formula_1 b formula_2 c formula_1 d formula_4'
+    assert extract.splitParts('a|{{b|c}}|[[d|e]]f|') == ['a', '{{b|c}}', '[[d|e]]f', '']
+
+
+def test_drop_move_infoboxes() -> None:
+    text = ('a<div class="box move_infobox">Info<div>inner</div></div>b'
+            "<div class='other'>c</div><div id=x class=move_infobox>d<div class=\"move_infobox\">e</div></div>f"
+            '<div class="move_infobox_x">g</div><div class="move_infobox">unclosed<div>h</div>')
+    assert extract.dropMoveInfoboxes(text) == \
+        "ab<div class='other'>c</div>f<div class=\"move_infobox_x\">g</div>"
+    text = ('a<DIV CLASS="move_infobox">b<DIV>c</DIV></DIV>d<div Class=\'move_infobox x\'>e</div>f'
+            '<p><div class="move_infobox">g</p>h<div class="move_infobox"/>i<br class="move_infobox">j')
+    assert extract.dropMoveInfoboxes(text) == 'adf<p></p>hi<br class="move_infobox">j'
+
+
+def test_html_entities() -> None:
+    extractor = Extractor('1', '1', '', '', 'Page', [])
+    extractor.HtmlFormatting = True
+    # the references left are decoded, except those that would make markup
+    texts = {'a&amp;nbsp;b &amp;quot;q&amp;quot; &amp;mdash;': 'a\xa0b "q" \u2014',
+             'x &lt; y &gt; z &amp;amp; w': 'x < y > z &amp; w',
+             'a < b > c & d': 'a < b > c & d',
+             '&amp;#160; &amp;#x41; &amp;bogus; &amp;amp': '\xa0 A &bogus; &amp',
+             '&amp;copy<div class="move_infobox">i</div> &amp;#150;': '\xa9 \u2013'}
+    assert {text: extract.clean(extractor, text, expand_templates=False, html_safe=False)
+            for text in texts} == texts
+    # the rest is left as it is
+    assert extract.unescapeHtmlText('a < b &amp; <p title="&nbsp;"> \n </p><!-- &nbsp; --> &lt;x&gt; '
+                                    '&nbsp;&copy &mdash;&mdash') == \
+        'a < b &amp; <p title="&nbsp;"> \n </p><!-- &nbsp; --> &lt;x&gt; \xa0\xa9 \u2014&mdash'
+
+
+def test_expansion_cache_budgets(doubling: dict[str, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    doubling['Template:Wrap'] = '{{D3}}'
+    doubling['Template:Wrap2'] = '{{Wrap}}'
+    monkeypatch.setattr(Extractor, 'maxTemplateRecursionLevels', 6)
+    monkeypatch.setattr(Extractor, 'maxExpansionNodes', 40)
+    pages = ['{{D3}}', '{{Wrap}}', '{{Wrap2}}', '{{Wrap}}{{D3}}', '{{D4}}{{D3}}']
+    cold = []
+    for text in pages:
+        monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(100))
+        cold.append(expand(text))
+    assert cold == ['xxxxxxxx', 'xxxxxxxx', '', 'xxxxxxxx' * 2, '']
+    # the same, with the expansions cached by the previous pages
+    monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(100))
+    assert [expand(text) for text in pages] == cold
+    assert extract.expansionCache.stats()['hits'] >= 4
@@ -0,0 +1,37 @@
+import io
+from typing import Callable
+
+import pytest
+
+from wikiextractor import extract
+from wikiextractor.WikiExtractor import load_templates
+
+
+@pytest.fixture
+def dump(xml_page: Callable[..., str]) -> str:
+    """
+    The pages of templates of a dump, some redefined.
+    """
+    pages = []
+    for i in range(300):
+        title = 'Template:T%d' % (i % 250)  # some are redefined
+        if i % 11 == 0:
+            text = '#REDIRECT [[Template:T%d]]' % (i + 1)
+        else:
+            text = '&lt;noinclude&gt;Doc %d&lt;/noinclude&gt;Body %d &lt;!-- c --&gt;{{{1}}}' % (i, i)
+        pages.append(xml_page(title, i + 1, i + 1001, text, 10))
+    return ''.join(pages)
+
+
+@pytest.mark.parametrize('process_count', [1, 3])
+def test_load_templates(monkeypatch: pytest.MonkeyPatch, dump: str, process_count: int) -> None:
+    monkeypatch.setattr(extract, 'templates', {})
+    monkeypatch.setattr(extract, 'redirects', {})
+    monkeypatch.setattr(extract.Extractor, 'templatePrefix', 'Template:')
+    monkeypatch.setattr('wikiextractor.WikiExtractor.jobBatchSize', 7)
+    assert load_templates(io.StringIO(dump), process_count=process_count) == 300
+    assert len(extract.redirects) == 28
+    # the last definition wins
+    assert extract.templates['Template:T1'] == 'Body 251 {{{1}}}'
+    assert extract.templates['Template:T249'] == 'Body 249 {{{1}}}'
+    assert len(extract.templates) == 232
@@ -0,0 +1,169 @@
+import io
+import os
+import pickle
+from multiprocessing import Queue
+from typing import Any, Callable, Optional, cast
+
+import pytest
+
+from wikiextractor import WikiExtractor, extract
+from wikiextractor.WikiExtractor import dispatch_pages, process_dump, reduce_process
+
+
+@pytest.fixture
+def dump(tmp_path, xml_header: str, xml_page: Callable[..., str]) -> str:
+    """
+    A dump whose templates are defined after the pages using them, with an
+    empty page and a page repeated with the same id.
+    """
+    filename = str(tmp_path / 'dump.xml')
+    with open(filename, 'w') as f:
+        f.write(xml_header)
+        for i in range(1, 41):
+            body = "'''Page %d''' is {{Greet|page %d}}.\n\nIt has {{Size}} text.\n" % (i, i)
+            if i == 13:
+                body += 'Long text. ' * 200
+            f.write(xml_page('Page %d' % i, i, 1000 + i, body))
+            if i == 7:
+                f.write(xml_page('Page %d' % i, i, 2000 + i, 'Repeated.'))
+        f.write(xml_page('Empty', 41, 1041, None))
+        f.write(xml_page('Template:Greet', 42, 1042, 'a page called {{{1}}}', 10))
+        f.write(xml_page('Template:Size', 43, 1043, 'some', 10))
+        f.write('</mediawiki>\n')
+    return filename
+
+
+@pytest.fixture
+def run(monkeypatch: pytest.MonkeyPatch, tmp_path) -> Callable[..., str]:
+    """
+    Run process_dump() as a new run would, starting with no templates.
+    :return: a function taking the name of the output directory and the
+        arguments of process_dump() after the output directory.
+    """
+    def run(dump: str, name: str, *args: Any, **kwargs: Any) -> str:
+        monkeypatch.setattr(extract, 'templates', {})
+        monkeypatch.setattr(extract, 'redirects', {})
+        monkeypatch.setattr(extract, 'rawTemplates', {})
+        monkeypatch.setattr(extract, 'templateCache', extract.LRUCache(extract.templateCacheSize))
+        monkeypatch.setattr(extract, 'expansionCache', extract.LRUCache(extract.expansionCacheSize))
+        monkeypatch.setattr(extract, 'resolvedTitles', {})
+        out = str(tmp_path / name)
+        os.makedirs(out)
+        process_dump(dump, None, out, *args, **kwargs)
+        return out
+    return run
+
+
+def read_docs(dir: str) -> str:
+    with open(os.path.join(dir, 'AA', 'wiki_00')) as f:
+        return f.read()
+
+
+def test_single_pass(dump: str, run: Callable[..., str], same_trees: Callable[[str, str], bool]) -> None:
+    two_pass = run(dump, 'two_pass', 1 << 20, False, 2, True)
+    single_pass = run(dump, 'single_pass', 1 << 20, False, 2, True, single_pass=True)
+    assert same_trees(two_pass, single_pass)
+    docs = read_docs(single_pass)
+    assert docs.count('<doc ') == 41
+    assert 'Page 7 is a page called page 7.' in docs
+    assert 'Repeated' not in docs
+    # the spill file is removed
+    assert sorted(os.listdir(single_pass)) == ['AA', 'pages2ids.jsonl']
+
+
+def test_single_pass_error(dump: str, run: Callable[..., str], monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    def fail(*args: Any) -> None:
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(WikiExtractor, 'map_pages', fail)
+    with pytest.raises(KeyboardInterrupt):
+        run(dump, 'single_pass', 1 << 20, False, 2, True, single_pass=True)
+    # the spill file is removed
+    assert not list((tmp_path / 'single_pass').glob('spill*'))
+
+
+class ListQueue(list):
+
+    """
+    Queue of a single process, passed where a multiprocessing Queue is expected.
+    """
+
+    def put(self, item: Any) -> None:
+        self.append(item)
+
+    def get(self) -> Any:
+        return self.pop(0)
+
+
+def test_dispatch_pages(monkeypatch: pytest.MonkeyPatch) -> None:
+    pages = [(str(i), str(1000 + i), '', 'Page %d' % i, ['x' * (500 if i in (5, 6, 11) else 10) + '\n'])
+             for i in range(1, 21)]
+    pages[8] = ('9', '1009', '', 'Page 9', ['#REDIRECT [[Page 8]]\n'])
+    monkeypatch.setattr(WikiExtractor, 'jobBatchBytes', 100)
+    single = ListQueue()
+    monkeypatch.setattr(WikiExtractor, 'jobBatchSize', 1)
+    assert dispatch_pages(iter(pages), '', cast(Queue, single))[0] == 19
+    assert all(len(batch) == 1 for _, batch in single)
+    batched = ListQueue()
+    monkeypatch.setattr(WikiExtractor, 'jobBatchSize', 4)
+    assert dispatch_pages(iter(pages), '', cast(Queue, batched))[0] == 19
+    # the same jobs, with the ordinal of the first one of each batch
+    assert [(ordinal + i, job) for ordinal, batch in batched for i, job in enumerate(batch)] == \
+        [(ordinal, job) for ordinal, (job,) in single]
+    # large pages go alone
+    assert [[job[0] for job in batch] for _, batch in batched] == \
+        [['1', '2', '3', '4'], ['5'], ['6'], ['7', '8', '10'], ['11'], ['12', '13', '14', '15'],
+         ['16', '17', '18', '19'], ['20']]
+
+
+def test_batches(dump: str, run: Callable[..., str], same_trees: Callable[[str, str], bool],
+                 monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(WikiExtractor, 'jobBatchSize', 1)
+    single = run(dump, 'single', 1 << 20, False, 2, True)
+    monkeypatch.setattr(WikiExtractor, 'jobBatchSize', 3)
+    monkeypatch.setattr(WikiExtractor, 'jobBatchBytes', 1000)  # page 13 goes alone
+    batched = run(dump, 'batched', 1 << 20, False, 2, True)
+    assert same_trees(single, batched)
+
+
+class SpillFile(io.BytesIO):
+
+    """
+    Spill file of reduce_process(), recording the sizes it is truncated from.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.truncated: list[int] = []
+        spill_files.append(self)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        self.truncated.append(len(self.getbuffer()))
+        return super().truncate(size)
+
+    def close(self) -> None:
+        self.final_size = len(self.getbuffer())
+        super().close()
+
+
+spill_files: list[SpillFile] = []
+
+
+def test_reduce_spill(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr('tempfile.TemporaryFile', lambda **kwargs: SpillFile())
+    spill_files.clear()
+    texts = ['Text %04d\n' % i for i in range(12)]  # 10 characters
+    queue = ListQueue()
+    # 0 arrives after 1 to 4, then 5 after 6 to 9
+    for ordinal in [1, 2, 3, 4, 0, 6, 7, 8, 9, 5, 10]:
+        queue.put((ordinal, [texts[ordinal]]))
+    queue.put((11, texts[11:]))
+    queue.put(None)
+    output = io.StringIO()
+    reduce_process(cast(Queue, queue), output, buffer_limit=25)
+    assert output.getvalue() == ''.join(texts)
+    spill, = spill_files
+    # 3, 4 and then 8, 9 are spilled, the file is emptied when they are written
+    record = len(pickle.dumps([texts[0]], pickle.HIGHEST_PROTOCOL)) + 4
+    assert spill.truncated == [2 * record, 2 * record]
+    assert spill.final_size == 0
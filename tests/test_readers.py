@@ -0,0 +1,175 @@
+import bz2
+import os
+import random
+import time
+from typing import Callable
+
+import pytest
+
+from wikiextractor import WikiExtractor
+from wikiextractor.WikiExtractor import (MultistreamReader, SevenZipReader, bz2_stream_offsets, collect_pages,
+                                         decode_open, decompress_streams, multistream_open, page_ranges,
+                                         process_dump, range_open)
+
+
+@pytest.fixture
+def pages(xml_page: Callable[..., str]) -> Callable[[int, int], str]:
+    """
+    :return: a function returning the XML of the pages numbered from
+        start to stop.
+    """
+    def pages(start: int, stop: int) -> str:
+        return ''.join(xml_page('Page %d' % i, i, i + 1000, 'Page %d is a page.' % i) for i in range(start, stop))
+    return pages
+
+
+@pytest.fixture
+def multistream(tmp_path, xml_header: str, pages: Callable[[int, int], str]) -> tuple[str, str, str]:
+    """
+    A multistream dump, as the dumps of Wikipedia, where the header and each
+    group of 10 pages are compressed as separate streams, with its index.
+    :return: the dump, its index and the uncompressed text.
+    """
+    parts = [xml_header] + [pages(i, i + 10) for i in range(0, 50, 10)] + ['</mediawiki>\n']
+    filename = str(tmp_path / 'test-multistream.xml.bz2')
+    index = []
+    offset = 0
+    with open(filename, 'wb') as f:
+        for i, part in enumerate(parts):
+            data = bz2.compress(part.encode('utf-8'))
+            if 0 < i < len(parts) - 1:
+                index.append('%d:%d:Page %d\n' % (offset, (i - 1) * 10, (i - 1) * 10))
+            f.write(data)
+            offset += len(data)
+    index_file = str(tmp_path / 'test-multistream-index.txt.bz2')
+    with bz2.open(index_file, 'wt') as f:
+        f.writelines(index)
+    return filename, index_file, ''.join(parts)
+
+
+def test_multistream_offsets(multistream: tuple[str, str, str]) -> None:
+    filename, index_file, _ = multistream
+    offsets = bz2_stream_offsets(filename)
+    assert len(offsets) == 7
+    # the index does not list the last stream, which is read with the previous one
+    assert bz2_stream_offsets(filename, index_file) == offsets[:-1]
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_multistream_open(multistream: tuple[str, str, str], monkeypatch: pytest.MonkeyPatch,
+                          use_index: bool) -> None:
+    filename, index_file, text = multistream
+    monkeypatch.setattr(WikiExtractor, 'streamGroupSize', 1)  # a task per stream
+    with decode_open(filename) as f:
+        assert f.read() == text
+    with multistream_open(filename, 2, index_file if use_index else None) as f:
+        assert f.read() == text
+
+
+def test_false_stream_header(multistream: tuple[str, str, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    filename, _, text = multistream
+    monkeypatch.setattr(WikiExtractor, 'streamGroupSize', 1)
+    offsets = bz2_stream_offsets(filename)
+    # offsets falling inside streams, as a header occurring by chance would
+    false = [(offsets[1] + offsets[2]) // 2, (offsets[3] + offsets[4]) // 2, offsets[-1] + 5]
+    reader = MultistreamReader(filename, sorted(offsets + false), 2)
+    with reader:
+        assert reader.read().decode('utf-8') == text
+
+
+
+def test_long_false_stream_header(tmp_path) -> None:
+    # a stream whose block fails its check only at its end, more than a chunk
+    # of compressed data after the header
+    data = bz2.compress(random.Random(0).randbytes(800000))
+    data = data[:10] + bytes(b ^ 0xff for b in data[10:14]) + data[14:]
+    filename = str(tmp_path / 'false.bz2')
+    with open(filename, 'wb') as f:
+        f.write(data)
+    assert decompress_streams(filename, 0, len(data)) == (0, 0, None)
+
+
+@pytest.fixture
+def seven_zip(tmp_path, xml_header: str, pages: Callable[[int, int], str]) -> tuple[str, str]:
+    py7zr = pytest.importorskip('py7zr')
+    # larger than the blocks queued by the reader, stored to be quick
+    text = xml_header + pages(0, 100000) + '</mediawiki>\n'
+    filename = str(tmp_path / 'test.xml.7z')
+    with py7zr.SevenZipFile(filename, 'w', filters=[{'id': py7zr.FILTER_COPY}]) as archive:
+        archive.writestr(text.encode('utf-8'), 'test.xml')
+    return filename, text
+
+
+def test_seven_zip(seven_zip: tuple[str, str]) -> None:
+    filename, text = seven_zip
+    with decode_open(filename) as f:
+        assert f.read() == text
+
+
+def test_seven_zip_close(seven_zip: tuple[str, str]) -> None:
+    filename, text = seven_zip
+    reader = SevenZipReader(filename)
+    assert reader.read(1000).decode('utf-8') == text[:1000]
+    deadline = time.monotonic() + 10
+    while not reader.queue.full() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the extracting thread is blocked on the full queue
+    assert reader.thread.is_alive()
+    reader.close()
+    assert not reader.thread.is_alive()
+    assert reader.error is None
+
+
+@pytest.fixture
+def dump(tmp_path, xml_header: str, xml_page: Callable[..., str]) -> str:
+    """
+    An uncompressed dump where some pages are repeated with the same id.
+    """
+    filename = str(tmp_path / 'dump.xml')
+    with open(filename, 'w') as f:
+        f.write(xml_header)
+        for i in range(30):
+            f.write(xml_page('Page %d' % i, i, i + 1000, 'Page %d is a page.' % i))
+            if i % 4 == 1:
+                f.write(xml_page('Page %d' % (i + 100), i, i + 2000, 'Page %d is a page.' % (i + 100)))
+        f.write('</mediawiki>\n')
+    return filename
+
+
+@pytest.mark.parametrize('count', [1, 3, 8, 100])
+def test_page_ranges(dump: str, monkeypatch: pytest.MonkeyPatch, count: int) -> None:
+    monkeypatch.setattr(WikiExtractor, 'templateNamespace', 'Template')
+    ranges = page_ranges(dump, count)
+    assert 0 < len(ranges) <= count
+    with open(dump, 'rb') as f:
+        data = f.read()
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[start:].lstrip().startswith(b'<page>')
+    with open(dump) as f:
+        pages = list(collect_pages(f))
+    assert len(pages) == 30
+    assert [page for start, end in ranges for page in collect_pages(range_open(dump, start, end))] == pages
+
+
+def test_map_ranges(dump: str, tmp_path, same_trees: Callable[[str, str], bool]) -> None:
+    single = str(tmp_path / 'single')
+    process_dump(dump, None, single, 0, False, 2, True, expand_templates=False)
+    ranges = str(tmp_path / 'ranges')
+    process_dump(dump, None, ranges, 0, False, 2, True, expand_templates=False, byte_ranges=True)
+    assert same_trees(single, ranges)
+    with open(os.path.join(ranges, 'pages2ids.jsonl')) as f:
+        assert len(f.readlines()) == 30
+
+
+def test_map_ranges_error(dump: str, tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def fail(*args) -> None:
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(WikiExtractor, 'map_ranges', fail)
+    out = tmp_path / 'ranges'
+    with pytest.raises(KeyboardInterrupt):
+        process_dump(dump, None, str(out), 0, False, 2, True, expand_templates=False, byte_ranges=True)
+    # no spool files are left among the output
+    assert not list(out.glob('ranges*'))
@@ -0,0 +1,96 @@
+import bz2
+import glob
+import os
+from typing import Callable
+
+import pytest
+
+from wikiextractor.WikiExtractor import merge_dump_shards, process_dump, read_shards
+
+
+def text(i: int) -> str:
+    if i % 7 == 3:
+        return '#REDIRECT [[Page %d]]' % (i - 1)
+    return "'''Page %d''' is a page.\n\nIt has text.\n" % i
+
+
+@pytest.fixture
+def dump(tmp_path, xml_header: str, xml_page: Callable[..., str]) -> str:
+    filename = str(tmp_path / 'dump.xml')
+    with open(filename, 'w') as f:
+        f.write(xml_header)
+        # ids not in dump order
+        for i in range(40):
+            f.write(xml_page('Page %d' % i, (i * 17) % 40 + 1, 1000 + i, text(i)))
+        f.write('</mediawiki>\n')
+    return filename
+
+
+@pytest.mark.parametrize('shard_by', ['bytes', 'id'])
+def test_merge_dump_shards(dump: str, tmp_path, same_trees: Callable[[str, str], bool], shard_by: str) -> None:
+    single = str(tmp_path / 'single')
+    process_dump(dump, None, single, 0, False, 2, True, expand_templates=False)
+    sharded = str(tmp_path / 'sharded')
+    for k in (1, 2, 3):
+        # the last node starts first
+        process_dump(dump, None, sharded, 0, False, 2, True, expand_templates=False,
+                     shard=(4 - k, 3), shard_by=shard_by)
+    assert merge_dump_shards(sharded, 0, False) == 34
+    assert same_trees(single, sharded)
+
+
+def documents(dir: str) -> list[str]:
+    """
+    :return: the documents in the output files in :param dir:, in the order
+        of the files.
+    """
+    docs: list[str] = []
+    for filename in sorted(glob.glob(os.path.join(dir, '**', 'wiki_*'), recursive=True)):
+        with (bz2.open if filename.endswith('.bz2') else open)(filename, 'rt', encoding='utf-8') as f:
+            docs.extend(doc + '</doc>\n' for doc in f.read().split('</doc>\n')[:-1])
+    return docs
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_unordered_shards(dump: str, tmp_path, compress: bool) -> None:
+    ordered = str(tmp_path / 'ordered')
+    process_dump(dump, None, ordered, 1 << 20, compress, 2, True, expand_templates=False)
+    docs = documents(ordered)
+    assert len(docs) == 34
+    unordered = str(tmp_path / 'unordered')
+    process_dump(dump, None, unordered, 1 << 20, compress, 3, True, expand_templates=False, unordered=True)
+    assert len(glob.glob(os.path.join(unordered, 'shard*'))) == 3
+    assert all(name.endswith('.bz2') == compress
+               for name in glob.glob(os.path.join(unordered, '*', '*', 'wiki_*')))
+    assert sorted(documents(unordered)) == sorted(docs)
+    merged = str(tmp_path / 'merged')
+    process_dump(dump, None, merged, 1 << 20, compress, 3, True, expand_templates=False,
+                 unordered=True, merge=True)
+    assert documents(merged) == docs
+
+
+def test_missing_shard(dump: str, tmp_path) -> None:
+    process_dump(dump, None, str(tmp_path), 0, False, 1, True, expand_templates=False, shard=(1, 2))
+    with pytest.raises(ValueError):
+        merge_dump_shards(str(tmp_path), 0, False)
+
+
+def write_shard(dir: str, texts: list[tuple[int, str]], files: list[str]) -> str:
+    """
+    Write a shard as shard_process() does, with :param texts: as pairs of
+    ordinal and text, held in :param files:.
+    """
+    os.makedirs(os.path.join(dir, 'AA'))
+    for i, content in enumerate(files):
+        with open(os.path.join(dir, 'AA', 'wiki_%02d' % i), 'w') as f:
+            f.write(content)
+    with open(os.path.join(dir, 'index'), 'w') as f:
+        f.writelines('%d %d\n' % (ordinal, len(text)) for ordinal, text in texts)
+    return dir
+
+
+def test_read_shards_empty(tmp_path) -> None:
+    # empty texts, within a file and at the end of one
+    a = write_shard(str(tmp_path / 'a'), [(0, 'x'), (2, ''), (4, 'yy'), (6, ''), (8, 'z')], ['xyy', 'z'])
+    b = write_shard(str(tmp_path / 'b'), [(1, ''), (3, 'w')], ['w'])
+    assert list(read_shards([a, b])) == ['x', '', '', 'w', 'yy', '', 'z']
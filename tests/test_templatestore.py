@@ -0,0 +1,44 @@
+import pytest
+
+from wikiextractor.templatestore import TemplateCache, TemplateStore, is_template_cache
+from wikiextractor.WikiExtractor import open_template_cache
+
+
+@pytest.mark.parametrize('mapping', [
+    {},
+    {'Template:A': 'a'},
+    {'Template:%d' % i: 'body %d {{{1}}}' % i * (i % 5) for i in range(1000)},
+    {'Template:Città': 'città ☃', 'Template:Empty': '', 'Template:Ü': 'x' * 100000},
+])
+def test_freeze(tmp_path, mapping: dict[str, str]) -> None:
+    store = TemplateStore.freeze(mapping, str(tmp_path))
+    assert len(store) == len(mapping)
+    assert dict(store) == mapping
+    for key, value in mapping.items():
+        assert key in store
+        assert store.get(key) == value
+    assert 'Template:Missing' not in store
+    assert store.get('Template:Missing') is None
+    with pytest.raises(KeyError):
+        store['Template:Missing']
+    # the file is anonymous
+    assert not list(tmp_path.iterdir())
+    store.close()
+
+
+def test_template_cache(tmp_path) -> None:
+    dump = tmp_path / 'dump.xml'
+    dump.write_text('<mediawiki>\n</mediawiki>\n')
+    filename = str(tmp_path / 'templates')
+    info = {'dump': {'name': 'dump.xml', 'size': dump.stat().st_size, 'mtime': int(dump.stat().st_mtime)},
+            'templateNamespace': 'Template'}
+    TemplateCache.write(filename, info, {'Template:A': 'a'}, {'Template:B': 'Template:A'})
+    assert is_template_cache(filename)
+    cache = open_template_cache(filename, str(dump))
+    assert cache
+    assert cache.info == info
+    assert dict(cache.templates) == {'Template:A': 'a'}
+    assert dict(cache.redirects) == {'Template:B': 'Template:A'}
+    # stale after the dump changes
+    dump.write_text('<mediawiki>\n\n</mediawiki>\n')
+    assert open_template_cache(filename, str(dump)) is None
@@ -0,0 +1,56 @@
+import io
+
+import pytest
+
+from wikiextractor import tokenizer
+from wikiextractor.tokenizer import iter_blocks, iter_pages
+
+dump = '''  <page>
+    <title>Page</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>10</id>
+      <timestamp>2024-01-01T00:00:00Z</timestamp>
+      <contributor>
+        <id>77</id>
+      </contributor>
+      <comment>first</comment>
+      <text bytes="9" xml:space="preserve">one
+two</text>
+    </revision>
+    <revision>
+      <id>11</id>
+      <timestamp>2024-02-01T00:00:00Z</timestamp>
+      <text bytes="0" />
+      <sha1>abc</sha1>
+    </revision>
+  </page>
+'''
+
+
+def test_iter_pages() -> None:
+    page, = iter_pages(io.StringIO(dump), raw=True)
+    assert (page.id, page.revid, page.timestamp, page.title, page.ns) == \
+        ('1', '10', '2024-02-01T00:00:00Z', 'Page', '0')
+    assert ''.join(page.text) == 'one\ntwo\n'
+    assert ''.join(page.lines) == dump
+
+    first, second = iter_pages(io.StringIO(dump), revisions=True, raw=True)
+    assert (first.id, first.revid, first.comment, ''.join(first.text)) == ('1', '10', 'first', 'one\ntwo')
+    assert (second.id, second.revid, second.comment, ''.join(second.text)) == ('1', '11', '', '\n')
+    assert first.lines[0] == '      <id>10</id>\n'
+    assert second.lines[-1] == '      <sha1>abc</sha1>\n'
+
+
+@pytest.mark.parametrize("size", [7, 64, 1024])
+def test_iter_blocks(size: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(tokenizer, 'blockSize', size)   # blocks spanning reads
+    xml = '<mediawiki>\n' + dump * 3 + '</mediawiki>'
+    blocks = list(iter_blocks(io.StringIO(xml), '<page>', '</page>'))
+    assert blocks == [dump] * 3
+    blocks = list(iter_blocks(iter(xml.splitlines(True)), '<page>', '</page>'))
+    assert blocks == [dump] * 3
+    # no newline at the end
+    xml = '<mediawiki>\n' + dump * 2 + dump.rstrip()
+    assert list(iter_blocks(io.StringIO(xml), '<page>', '</page>')) == [dump, dump, dump.rstrip()]
@@ -55,19 +55,36 @@ collecting template definitions.
 
 import argparse
 import bz2
+import glob
+import heapq
 import html
+import io
 import json
 import logging
+import mmap
 import os.path
+import pickle
+import queue
 import re  # TODO use regex when it will be standard
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+from collections import Counter, deque
 from gzip import GzipFile
 from io import StringIO
 from multiprocessing import Queue, cpu_count, get_context
 from timeit import default_timer
-from typing import IO, Any, Iterator, Optional, TextIO, Union
+from typing import IO, Any, Callable, Iterator, Optional, TextIO, Union
 
-from .extract import Extractor, acceptedNamespaces, define_template, ignoreTag
+from .extract import (Extractor, acceptedNamespaces, add_template, cache_stats, define_template,
+                      expansionCache, expansionCacheSize, fold_constant_templates, freeze_templates,
+                      ignoreTag, open_parse_cache, reTemplateRedirect, resolve_redirects,
+                      save_parsed_templates, save_templates, template_body, templateCache,
+                      templateCacheSize, update_parse_cache, use_templates)
+from .templatestore import TemplateCache, is_template_cache
+from .tokenizer import iter_pages, tagRE
 
 # ===========================================================================
 
@@ -162,7 +179,7 @@ class OutputSplitter():
     def write(self, data: str) -> None:
         self.reserve(len(data))
         if self.compress:
-            self.file.write(data)
+            self.file.write(data.encode('utf-8'))
         else:
             self.file.write(data)
 
@@ -186,88 +203,141 @@ redirect_patterns = [
     re.compile(r'(?i)^#REDIRECT:\[\[(.*?)\]\]')
 ]
 disambiguation_pattern = re.compile(r'(?i){{disambig|Disambig}}')
-tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
-#                    1     2               3      4
 
 
-def load_templates(file: Union[TextIO, IO[Any], GzipFile], output_file: Optional[str] =None) -> int:
+def template_bodies(batch: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Process the bodies of a batch of templates, in a pool process.
+    :param batch: pairs (title, text of the template page).
+    :return: pairs (title, body).
+    """
+    return [(title, template_body(text)) for title, text in batch]
+
+
+def load_templates(file: Union[TextIO, IO[Any], GzipFile], spill: Optional[IO[bytes]] = None,
+                   lazy: bool = False, process_count: int = 1) -> int:
     """
-    Load templates from :param file:.
-    :param output_file: file where to save templates and modules.
+    Load templates from :param file:, a dump or a template file in the XML
+    format of older versions.
+    :param spill: file where to save the pages to extract, so that they can
+        be replayed by spilled_pages() without reading :param file: again.
+    :param lazy: whether to process the body of templates only when used.
+    :param process_count: number of processes for processing the bodies of
+        templates, which are then added in the order of the dump.
     :return: number of templates loaded.
     """
     global templateNamespace
-    global moduleNamespace
-    modulePrefix = moduleNamespace + ':'
     articles = 0
     templates = 0
-    page = []
-    inText = False
-    if output_file:
-        output = open(output_file, 'w')
-    for line in file:
-        assert isinstance(line, str)
-        #line = line.decode('utf-8')
-        if '<' not in line:  # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-        elif tag == 'title':
-            title = m.group(3)
-            if not output_file and not templateNamespace:  # do not know it yet
-                # we reconstruct it from the first title
-                colon = title.find(':')
-                if colon > 1:
-                    templateNamespace = title[:colon]
-                    Extractor.templatePrefix = title[:colon + 1]
-            # FIXME: should reconstruct also moduleNamespace
-        elif tag == 'text':
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif inText:
-            page.append(line)
-        elif tag == '/page':
-            if title.startswith(Extractor.templatePrefix):
-                define_template(title, page)
-                templates += 1
-            # save templates and modules to file
-            if output_file and (title.startswith(Extractor.templatePrefix) or
-                                title.startswith(modulePrefix)):
-                output.write('<page>\n')
-                output.write('   <title>%s</title>\n' % title)
-                output.write('   <ns>10</ns>\n')
-                output.write('   <text>')
-                for line in page:
-                    output.write(line)
-                output.write('   </text>\n')
-                output.write('</page>\n')
-            page = []
-            articles += 1
-            if articles % 100000 == 0:
-                logging.info("Preprocessed %d pages", articles)
-    if output_file:
-        output.close()
-        logging.info("Saved %d templates to '%s'", templates, output_file)
+    last_id = ''
+    pool = get_context("fork").Pool(process_count) if process_count > 1 and not lazy else None
+    pending: deque = deque()    # results of batches, in order
+    batch: list[tuple[str, str]] = []
+    batch_bytes = 0
+
+    def add_templates(limit: int) -> None:
+        # add the processed templates, waiting for them while more than limit batches are pending
+        while pending and (len(pending) > limit or pending[0].ready()):
+            for title, text in pending.popleft().get():
+                add_template(title, text)
+
+    for id, revid, timestamp, title, ns, _, page, _ in iter_pages(file):
+        if not templateNamespace:  # do not know it yet
+            # we reconstruct it from the first title
+            colon = title.find(':')
+            if colon > 1:
+                templateNamespace = title[:colon]
+                Extractor.templatePrefix = title[:colon + 1]
+        # FIXME: should reconstruct also moduleNamespace
+        if title.startswith(Extractor.templatePrefix):
+            if pool and not reTemplateRedirect.match(page[0]):
+                text = ''.join(page)
+                batch.append((title, text))
+                batch_bytes += len(text)
+                if len(batch) >= jobBatchSize or batch_bytes >= jobBatchBytes:
+                    pending.append(pool.apply_async(template_bodies, (batch,)))
+                    batch = []
+                    batch_bytes = 0
+                    add_templates(10 * process_count)
+            else:
+                define_template(title, page, lazy)
+            templates += 1
+        # save pages to extract, selected as in collect_pages()
+        if spill:
+            colon = title.find(':')
+            if (ns == '0' or (title[:colon] in acceptedNamespaces)) and id != last_id and \
+               not title.startswith(templateNamespace):
+                write_record(spill, pickle.dumps((id, revid, timestamp, title, page), pickle.HIGHEST_PROTOCOL))
+                last_id = id
+        articles += 1
+        if articles % 100000 == 0:
+            logging.info("Preprocessed %d pages", articles)
+    if pool:
+        if batch:
+            pending.append(pool.apply_async(template_bodies, (batch,)))
+        add_templates(0)
+        pool.close()
+        pool.join()
     logging.info("Preprocessed %d pages", articles)
+    dropped = resolve_redirects()
+    if dropped:
+        logging.warning("Dropped %d redirects among templates forming cycles", dropped)
     return templates
 
 
+def dump_signature(input_file: str) -> Optional[dict[str, Any]]:
+    """
+    :return: what identifies the version of a dump file, to tell whether a
+        template cache was built from it, or None for stdin.
+    """
+    if input_file == '-':
+        return None
+    stat = os.stat(input_file)
+    return {"name": os.path.basename(input_file), "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+
+def open_template_cache(template_file: str, input_file: str) -> Optional[TemplateCache]:
+    """
+    Open the template cache :param template_file:, if it was built from
+    :param input_file:.
+    :return: the cache, or None if it must be rebuilt.
+    """
+    try:
+        cache = TemplateCache(template_file)
+    except ValueError:
+        logging.info("'%s' is a template cache of a different version: rebuilding it.", template_file)
+        return None
+    signature = dump_signature(input_file)
+    if signature and cache.info['dump'] != signature:
+        logging.info("'%s' was built from a different version of the dump: rebuilding it.", template_file)
+        cache.close()
+        return None
+    return cache
+
+
+def use_template_cache(cache: TemplateCache) -> int:
+    """
+    Use the templates in :param cache:, and its namespaces unless they are
+    already known from <siteinfo>.
+    :return: the number of templates.
+    """
+    global knownNamespaces
+    global templateNamespace
+    global moduleNamespace
+
+    use_templates(cache)
+    if not templateNamespace:
+        templateNamespace = cache.info['templateNamespace']
+        moduleNamespace = cache.info['moduleNamespace']
+        knownNamespaces.update(cache.info['knownNamespaces'])
+        Extractor.templatePrefix = templateNamespace + ':'
+    return len(cache.templates)
+
+
 def decode_open(filename: str, mode: str='rt', encoding: str='utf-8') -> Union[TextIO, IO[Any], GzipFile]:
     """
-    Open a file, decode and decompress, depending on extension `gz`, or 'bz2`.
+    Open a file, decode and decompress, depending on extension `gz`, 'bz2`
+    or `7z`.
     :param filename: the file to open.
     """
     ext = os.path.splitext(filename)[1]
@@ -276,77 +346,430 @@ def decode_open(filename: str, mode: str='rt', encoding: str='utf-8') -> Union[T
         return gzip.open(filename, mode, encoding=encoding)
     elif ext == '.bz2':
         return bz2.open(filename, mode=mode, encoding=encoding)
+    elif ext == '.7z':
+        reader = io.BufferedReader(SevenZipReader(filename), 1024 * 1024)
+        return io.TextIOWrapper(reader, encoding=encoding)
     else:
         return open(filename, mode, encoding=encoding)
 
 
+# ----------------------------------------------------------------------
+# 7z
+
+class SevenZipReader(io.RawIOBase):
+
+    """
+    Binary file-like object that streams the first member of a 7z archive.
+    Since py7zr pushes decompressed data to a writer, decompression runs in a
+    separate thread, that hands data over through a bounded queue, so that no
+    more than a few blocks are held in memory.
+    """
+
+    def __init__(self, filename: str, member: Optional[str] = None) -> None:
+        """
+        :param filename: the 7z archive.
+        :param member: the member to read, by default the first file.
+        """
+        super().__init__()
+        import py7zr
+        self.archive = py7zr.SevenZipFile(filename, 'r')
+        if not member:
+            member = next(f.filename for f in self.archive.list() if not f.is_directory)
+        self.member = member
+        self.queue: queue.Queue = queue.Queue(maxsize=16)
+        self.cancelled = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._extract, daemon=True)
+        self.thread.start()
+
+    def _extract(self) -> None:
+        from py7zr.io import Py7zIO, WriterFactory
+
+        reader = self
+
+        class QueueWriter(Py7zIO):
+
+            def __init__(self) -> None:
+                self.length = 0
+
+            def write(self, s: Union[bytes, bytearray]) -> int:
+                while not reader.cancelled.is_set():
+                    try:
+                        reader.queue.put(bytes(s), timeout=0.1)
+                        self.length += len(s)
+                        return len(s)
+                    except queue.Full:
+                        pass
+                raise EOFError("7z reader closed")
+
+            def read(self, size: Optional[int] = None) -> bytes:
+                return b''
+
+            def seek(self, offset: int, whence: int = 0) -> int:
+                return self.length
+
+            def flush(self) -> None:
+                pass
+
+            def size(self) -> int:
+                return self.length
+
+        class QueueWriterFactory(WriterFactory):
+
+            def create(self, filename: str) -> Py7zIO:
+                return QueueWriter()
+
+        try:
+            self.archive.extract(targets=[self.member], factory=QueueWriterFactory())
+        except BaseException as e:
+            if not self.cancelled.is_set():
+                self.error = e
+        finally:
+            self.archive.close()
+            if not self.cancelled.is_set():
+                self.queue.put(None)  # end of data
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        while self.offset >= len(self.buffer):
+            if self.eof:
+                return 0
+            chunk = self.queue.get()
+            if chunk is None:
+                self.eof = True
+                if self.error:
+                    raise OSError("Error decompressing '%s'" % self.member) from self.error
+                return 0
+            self.buffer = chunk
+            self.offset = 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.cancelled.set()
+            self.thread.join()
+        super().close()
+
+
+# ----------------------------------------------------------------------
+# Multistream bz2
+
+# Each stream of a multistream dump is an independent bz2 file, starting with
+# 'BZh' + block size, followed by the magic of its first block (BCD pi).
+bz2StreamRE = re.compile(rb'BZh[1-9]1AY&SY')
+
+##
+# Streams are decompressed in groups of about this many compressed bytes.
+streamGroupSize = 2 * 1024 * 1024
+
+
+def bz2_stream_offsets(filename: str, index_file: Optional[str] = None) -> list[int]:
+    """
+    Find the starting offsets of the independent streams of a bz2 dump.
+    :param filename: the bz2 dump.
+    :param index_file: the multistream index of the dump, with lines
+        "offset:id:title". If not given, the dump is scanned for stream headers.
+    :return: the sorted list of offsets.
+    """
+    if index_file:
+        offsets = {0}  # the siteinfo header is in a stream of its own
+        with decode_open(index_file) as index:
+            for line in index:
+                assert isinstance(line, str)
+                offsets.add(int(line[:line.find(':')]))
+        return sorted(offsets)
+    if not os.path.getsize(filename):
+        return []
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # A header might also occur by chance inside compressed data:
+        # MultistreamReader detects and skips such false boundaries.
+        return [m.start() for m in bz2StreamRE.finditer(mm)]
+
+
+def decompress_streams(filename: str, start: int, stop: int) -> tuple[int, int, Optional[bytes]]:
+    """
+    Decompress the consecutive bz2 streams of :param filename:, from the one
+    starting at byte :param start: to the one that ends at or after :param stop:.
+    :return: a triple (start, end, data), where end is the offset following
+        the last stream decompressed and data is None when :param start: is
+        not the beginning of a stream.
+    """
+    chunks: list[bytes] = []
+    pos = start
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = b''
+        try:
+            while pos < stop:
+                stream = pos  # where the current stream starts
+                decompressor = bz2.BZ2Decompressor()
+                while not decompressor.eof:
+                    if not data:
+                        data = f.read(256 * 1024)
+                        if not data:  # truncated dump
+                            return start, pos, b''.join(chunks)
+                    chunks.append(decompressor.decompress(data))
+                    if decompressor.eof:
+                        pos += len(data) - len(decompressor.unused_data)
+                        data = decompressor.unused_data
+                    else:
+                        pos += len(data)
+                        data = b''
+        except OSError:
+            if stream == start:
+                return start, start, None
+            raise
+    return start, pos, b''.join(chunks)
+
+
+class MultistreamReader(io.RawIOBase):
+
+    """
+    Binary file-like object that reads a multistream bz2 dump, decompressing
+    its streams in parallel in a pool of processes, while returning data in
+    the original order.
+    """
+
+    def __init__(self, filename: str, offsets: list[int], process_count: int) -> None:
+        """
+        :param filename: the bz2 dump.
+        :param offsets: offsets of the streams in the dump.
+        :param process_count: number of decompression processes.
+        """
+        super().__init__()
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        # group consecutive streams into tasks
+        self.tasks = []
+        start = offsets[0]
+        for offset in offsets[1:]:
+            if offset - start >= streamGroupSize:
+                self.tasks.append((start, offset))
+                start = offset
+        self.tasks.append((start, self.size))
+        self.pool = get_context("fork").Pool(process_count)
+        self.window = 2 * process_count  # tasks being decompressed ahead
+        self.chunks = self._chunks()
+        self.buffer = b''
+        self.offset = 0
+
+    def _results(self) -> Iterator[tuple[int, int, Optional[bytes]]]:
+        pending: deque = deque()
+        for task in self.tasks:
+            pending.append(self.pool.apply_async(decompress_streams, (self.filename, *task)))
+            if len(pending) > self.window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _chunks(self) -> Iterator[bytes]:
+        expected = self.tasks[0][0]  # offset where the next stream must begin
+        for start, end, data in self._results():
+            if start > expected:
+                # the task that should have covered this gap began at a false
+                # stream header, fill the gap here.
+                _, expected, gap = decompress_streams(self.filename, expected, start)
+                if gap is None:
+                    raise OSError("Invalid bz2 stream at offset %d" % expected)
+                yield gap
+            if start < expected:
+                continue        # falls within a stream already decompressed
+            if data is None:
+                # a false header: next result will trigger filling the gap
+                continue
+            yield data
+            expected = end
+        if expected < self.size:
+            _, _, tail = decompress_streams(self.filename, expected, self.size)
+            if tail is None:
+                raise OSError("Invalid bz2 stream at offset %d" % expected)
+            yield tail
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        while self.offset >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+            self.offset = 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.pool.terminate()
+            self.pool.join()
+        super().close()
+
+
+def multistream_open(filename: str, process_count: int, index_file: Optional[str] = None,
+                     encoding: str = 'utf-8') -> Union[TextIO, IO[Any], GzipFile]:
+    """
+    Open a bz2 dump for reading text, decompressing its streams in parallel
+    if it is a multistream dump.
+    :param filename: the bz2 dump.
+    :param process_count: number of decompression processes.
+    :param index_file: the multistream index of the dump, if available.
+    """
+    if not index_file:
+        # enwiki-...-multistream.xml.bz2 -> enwiki-...-multistream-index.txt.bz2
+        index = filename.replace('-multistream.xml.bz2', '-multistream-index.txt.bz2')
+        if index != filename and os.path.exists(index):
+            index_file = index
+    offsets = bz2_stream_offsets(filename, index_file)
+    if len(offsets) < 2:
+        # a single stream cannot be split
+        return decode_open(filename, encoding=encoding)
+    logging.info("Decompressing %d streams of '%s' with %d processes.",
+                 len(offsets), filename, process_count)
+    reader = MultistreamReader(filename, offsets, process_count)
+    return io.TextIOWrapper(io.BufferedReader(reader, 1024 * 1024), encoding=encoding)
+
+
+# ----------------------------------------------------------------------
+# Byte ranges of uncompressed dumps
+
+def page_id(mm: mmap.mmap, pos: int) -> bytes:
+    """
+    :return: the id of the page whose <page> tag is at :param pos:.
+    """
+    start = mm.find(b'<id>', pos) + 4
+    return mm[start:mm.find(b'</id>', start)]
+
+
+def page_ranges(filename: str, count: int) -> list[tuple[int, int]]:
+    """
+    Split an uncompressed dump into about :param count: byte ranges of similar
+    size, each one beginning at the line of a <page> tag.
+    A page with the same id as the previous one is kept in the range of the
+    latter, so that collect_pages() drops it as it does reading sequentially.
+    :return: a list of pairs (start, end).
+    """
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        bounds: list[int] = []
+        pos = 0
+        for i in range(count):
+            pos = mm.find(b'<page>', max(pos, size * i // count))
+            if pos < 0:
+                break
+            previous = mm.rfind(b'<page>', 0, pos)
+            while pos >= 0 and previous >= 0 and page_id(mm, previous) == page_id(mm, pos):
+                previous, pos = pos, mm.find(b'<page>', pos + 1)
+            if pos < 0:
+                break
+            start = mm.rfind(b'\n', 0, pos) + 1  # beginning of line
+            if not bounds or start > bounds[-1]:
+                bounds.append(start)
+            pos += 1
+    if not bounds:
+        return []
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class MappedRange(io.RawIOBase):
+
+    """
+    Binary file-like object reading a byte range of a memory mapped file.
+    """
+
+    def __init__(self, filename: str, start: int, end: int) -> None:
+        super().__init__()
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = start
+        self.end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        n = min(len(b), self.end - self.pos)
+        b[:n] = self.mm[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.mm.close()
+        super().close()
+
+
+def range_open(filename: str, start: int, end: int, encoding: str = 'utf-8') -> TextIO:
+    """
+    Open the byte range [:param start:, :param end:) of an uncompressed dump
+    for reading text.
+    """
+    reader = io.BufferedReader(MappedRange(filename, start, end), 1024 * 1024)
+    return io.TextIOWrapper(reader, encoding=encoding)
+
+
+# Spool files hold a sequence of length-prefixed records.
+
+def write_record(file: IO[bytes], data: bytes) -> None:
+    file.write(struct.pack('<I', len(data)))
+    file.write(data)
+
+
+def read_record(file: IO[bytes]) -> bytes:
+    header = file.read(4)
+    if not header:
+        return b''
+    return file.read(struct.unpack('<I', header)[0])
+
+
+def read_records(filename: str) -> Iterator[bytes]:
+    with open(filename, 'rb') as file:
+        while True:
+            header = file.read(4)
+            if not header:
+                break
+            yield file.read(struct.unpack('<I', header)[0])
+
+
+def spilled_pages(filename: str) -> Iterator[tuple[str, str, str, str, list[str]]]:
+    """
+    Replay the pages saved by load_templates() to :param filename:.
+    :return: the same tuples as collect_pages().
+    """
+    for record in read_records(filename):
+        yield pickle.loads(record)
+
+
 def collect_pages(text: Union[TextIO, IO[Any], GzipFile]) -> Iterator[tuple[str, str, str, str, list[str]]]:
     """
     :param text: the text of a wikipedia file dump.
+    :return: tuples (id, revid, timestamp, title, page) of the pages to extract.
     """
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
-    page: list[str] = []
-    id = ''
-    title = ''
-    revid = ''
-    namespace = ''
     last_id = ''
-    timestamp = ''
-    inText = False
-    for line in text:
-        assert isinstance(line, str)
-        if '<' not in line:     # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-        elif tag == 'id' and not id:
-            id = m.group(3)
-        elif tag == 'id' and id and not revid: # <revision> <id></id> </revision>
-            revid = m.group(3)
-        elif tag == 'id' and id and revid: # <contributor> <id></id> </contributor>
-            pass
-        elif tag == 'timestamp': # <revision> <id></id> </revision>
-            timestamp = m.group(3)
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'ns':
-            namespace = m.group(3)
-        elif tag == 'redirect':
-            pass
-        elif tag == 'text':
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif tag == '/page':
-            colon = title.find(':')
-            if (namespace == '0' or (title[:colon] in acceptedNamespaces)) and id != last_id and not title.startswith(templateNamespace):
-                yield (id, revid, timestamp, title, page)
-                last_id = id
-            id = ''
-            title = ''
-            revid = ''
-            namespace = ''
-            timestamp = ''
-            page = []
-            inText = False
-        elif inText:
-            page.append(line)
-
-def process_dump(input_file: str, template_file: str, out_file: str, file_size: int, file_compress: bool,
-                process_count: int, html_safe: bool, expand_templates: bool = True) -> None:
+    for id, revid, timestamp, title, ns, _, page, _ in iter_pages(text):
+        colon = title.find(':')
+        if (ns == '0' or (title[:colon] in acceptedNamespaces)) and id != last_id and not title.startswith(templateNamespace):
+            yield (id, revid, timestamp, title, page)
+            last_id = id
+
+
+def process_dump(input_file: str, template_file: Optional[str], out_file: str, file_size: int, file_compress: bool,
+                process_count: int, html_safe: bool, expand_templates: bool = True,
+                decompress_processes: int = 0, multistream_index: Optional[str] = None,
+                byte_ranges: bool = False, single_pass: bool = False, reorder_buffer: int = 0,
+                unordered: bool = False, merge: bool = False, shard: Optional[tuple[int, int]] = None,
+                shard_by: str = 'bytes', lazy_templates: bool = False,
+                parse_cache: Optional[str] = None, fold_templates: bool = False) -> None:
     """
     :param input_file: name of the wikipedia dump file; '-' to read from stdin
     :param template_file: optional file with template definitions.
@@ -356,6 +779,29 @@ def process_dump(input_file: str, template_file: str, out_file: str, file_size:
     :param process_count: number of extraction processes to spawn.
     :html_safe: whether to convert entities in text to HTML.
     :param expand_templates: whether to expand templates.
+    :param decompress_processes: number of processes for decompressing a
+        multistream bz2 dump; 0 or 1 to decompress sequentially.
+    :param multistream_index: optional index file of a multistream dump.
+    :param byte_ranges: whether to split an uncompressed dump into byte ranges
+        that are parsed and extracted in parallel.
+    :param single_pass: whether to read the dump only once, saving the pages
+        to extract to a spill file while collecting templates.
+    :param reorder_buffer: maximum size of extracted texts held in memory while
+        waiting for earlier ones; 0 for no limit.
+    :param unordered: whether each extract process should write its own shard
+        of output files, not in the order of the dump.
+    :param merge: whether to merge the shards in dump order at the end.
+    :param shard: a pair (k, n) to extract only the k-th of n slices of the
+        dump, writing it to a subdirectory of :param out_file: with a manifest,
+        for merging with merge_dump_shards() the output of several nodes.
+    :param shard_by: how to slice the dump for :param shard:: 'bytes' for
+        byte ranges of an uncompressed dump, 'id' by page id modulo n.
+    :param lazy_templates: whether to process the body of templates only
+        when they are first used.
+    :param parse_cache: optional file where to keep the parsed templates
+        across runs, updated with those parsed in this run.
+    :param fold_templates: whether to expand beforehand the templates that
+        do not depend on parameters or on the page.
     """
     global knownNamespaces
     global templateNamespace
@@ -363,7 +809,44 @@ def process_dump(input_file: str, template_file: str, out_file: str, file_size:
 
     urlbase = ''                # This is obtained from <siteinfo>
 
-    input = decode_open(input_file)
+    cache = None
+    legacy_templates = False    # template file in the old XML format
+    if expand_templates and template_file and os.path.exists(template_file):
+        if is_template_cache(template_file):
+            cache = open_template_cache(template_file, input_file)
+        else:
+            legacy_templates = True
+
+    if byte_ranges and (input_file == '-' or os.path.splitext(input_file)[1] in ('.gz', '.bz2', '.7z')):
+        logging.warning("Byte ranges require an uncompressed dump file: extracting sequentially.")
+        byte_ranges = False
+    # byte ranges read the dump through mmap anyway
+    single_pass = single_pass and expand_templates and not byte_ranges and \
+        not (cache or legacy_templates)
+    spill_file = None
+    if shard:
+        if shard_by == 'bytes' and (input_file == '-' or os.path.splitext(input_file)[1] in ('.gz', '.bz2', '.7z')):
+            logging.warning("Sharding by bytes requires an uncompressed dump file: sharding by id.")
+            shard_by = 'id'
+        out_file = dump_shard_dir(out_file, *shard)
+        os.makedirs(out_file, exist_ok=True)
+        if os.path.exists(os.path.join(out_file, 'manifest.json')):
+            os.remove(os.path.join(out_file, 'manifest.json'))
+        # each node writes unordered shards, merged later with the others
+        unordered, merge, byte_ranges = True, False, False
+        single_pass = single_pass and shard_by == 'id'
+    if unordered and (out_file == '-' or byte_ranges):
+        logging.warning("Unordered output requires an output directory and no byte ranges: writing in order.")
+        unordered = False
+
+    def open_input() -> Union[TextIO, IO[Any], GzipFile]:
+        if input_file == '-':
+            return sys.stdin
+        if decompress_processes > 1 and input_file.endswith('.bz2'):
+            return multistream_open(input_file, decompress_processes, multistream_index)
+        return decode_open(input_file)
+
+    input = open_input()
 
     # collect siteinfo
     for line in input:
@@ -389,37 +872,220 @@ def process_dump(input_file: str, template_file: str, out_file: str, file_size:
         elif tag == '/siteinfo':
             break
 
-    if expand_templates:
-        # preprocess
-        template_load_start = default_timer()
-        if template_file and os.path.exists(template_file):
-            logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", template_file)
-            file = decode_open(template_file)
-            templates = load_templates(file)
-            file.close()
+    try:
+        if expand_templates:
+            # preprocess
+            template_load_start = default_timer()
+            if cache:
+                templates = use_template_cache(cache)
+            elif legacy_templates and template_file:
+                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", template_file)
+                file = decode_open(template_file)
+                templates = load_templates(file, lazy=lazy_templates, process_count=process_count)
+                file.close()
+            elif single_pass:
+                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
+                fd, spill_file = tempfile.mkstemp(prefix='spill', dir=None if out_file == '-' else out_file)
+                with os.fdopen(fd, 'wb') as spill:
+                    templates = load_templates(input, spill, lazy_templates, process_count)
+                input.close()
+                logging.info("Saved pages to extract to '%s' (%d bytes)", spill_file, os.path.getsize(spill_file))
+            else:
+                if input_file == '-':
+                    # can't scan then reset stdin; must error w/ suggestion to specify template_file
+                    raise ValueError("to use templates with stdin dump, must supply explicit template-file")
+                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
+                templates = load_templates(input, lazy=lazy_templates, process_count=process_count)
+                input.close()
+                input = open_input()
+            if template_file and not (cache or legacy_templates):
+                save_templates(template_file, {
+                    "dump": dump_signature(input_file),
+                    "templateNamespace": templateNamespace,
+                    "moduleNamespace": moduleNamespace,
+                    "knownNamespaces": sorted(knownNamespaces)
+                })
+                logging.info("Saved %d templates to '%s'", templates, template_file)
+                cache = TemplateCache(template_file)
+                use_templates(cache)
+            elif not cache:
+                # shared by extract processes without copying
+                freeze_templates(None if out_file == '-' else out_file)
+            template_load_elapsed = default_timer() - template_load_start
+            logging.info("Loaded %d templates in %.1fs", templates, template_load_elapsed)
+            if fold_templates:
+                fold_start = default_timer()
+                folded = fold_constant_templates(None if out_file == '-' else out_file)
+                logging.info("Folded %d constant templates in %.1fs", folded, default_timer() - fold_start)
+            if parse_cache:
+                open_parse_cache(parse_cache, None if out_file == '-' else out_file)
+
+        output: TextIO | OutputSplitter = sys.stdout
+        if out_file == '-':
+            if file_compress:
+                logging.warn("writing to stdout, so no output compression (use an external tool)")
+        elif not unordered:
+            nextFile = NextFile(out_file)
+            output = OutputSplitter(nextFile, file_size, file_compress)
+
+        # process pages
+        logging.info("Starting page extraction from %s.", input_file)
+        extract_start = default_timer()
+
+        spill_dir = None if out_file == '-' else out_file
+        if byte_ranges:
+            input.close()
+            with tempfile.TemporaryDirectory(prefix='ranges', dir=spill_dir) as spool_dir:
+                ordinal, pages2ids = map_ranges(input_file, urlbase, output, process_count, html_safe, spool_dir)
         else:
-            if input_file == '-':
-                # can't scan then reset stdin; must error w/ suggestion to specify template_file
-                raise ValueError("to use templates with stdin dump, must supply explicit template-file")
-            logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-            templates = load_templates(input, template_file)
+            select = None
+            positions: list[int] = []  # of the pages of a shard in the dump
+            if shard:
+                k, n = shard
+                if shard_by == 'bytes':
+                    input.close()
+                    ranges = page_ranges(input_file, n)
+                    start, end = ranges[k - 1] if k <= len(ranges) else (0, 0)
+                    input = range_open(input_file, start, end)
+                else:
+                    select = lambda id: int(id) % n == k - 1  # noqa: E731
+            pages = spilled_pages(spill_file) if spill_file else collect_pages(input)
+            if unordered:
+                ordinal, pages2ids, shard_dirs = map_shards(pages, urlbase, out_file, file_size, file_compress,
+                                                            process_count, html_safe, select,
+                                                            positions if shard else None)
+            else:
+                ordinal, pages2ids = map_pages(pages, urlbase, output, process_count, html_safe,
+                                               reorder_buffer, spill_dir)
             input.close()
-            input = decode_open(input_file)
-        template_load_elapsed = default_timer() - template_load_start
-        logging.info("Loaded %d templates in %.1fs", templates, template_load_elapsed)
-
-    output: TextIO | OutputSplitter = sys.stdout
-    if out_file == '-':
-        if file_compress:
-            logging.warn("writing to stdout, so no output compression (use an external tool)")
-    else:
-        nextFile = NextFile(out_file)
-        output = OutputSplitter(nextFile, file_size, file_compress)
+    finally:
+        if spill_file:
+            # not left among the output in case of errors
+            os.remove(spill_file)
+
+    if output != sys.stdout:
+        output.close()
+    extract_duration = default_timer() - extract_start
+    extract_rate = ordinal / extract_duration
+    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)", process_count, ordinal, extract_duration, extract_rate)
+
+    if expand_templates and parse_cache:
+        added = update_parse_cache(parse_cache)
+        logging.info("Added %d parsed templates to '%s'", added, parse_cache)
+
+    with open(os.path.join(out_file, 'pages2ids.jsonl'), 'w', encoding='utf-8') as f:
+        # write pages2ids as json
+        for page2id in pages2ids:
+            f.write(json.dumps(page2id, ensure_ascii=False)+'\n')
+
+    if shard:
+        with open(os.path.join(out_file, 'positions'), 'w') as f:
+            f.writelines('%d\n' % position for position in positions)
+        manifest: dict[str, Any] = {
+            "input": os.path.basename(input_file),
+            "size": None if input_file == '-' else os.path.getsize(input_file),
+            "shard": shard[0], "shards": shard[1], "by": shard_by,
+            "articles": ordinal, "pages": len(pages2ids),
+            "parts": [os.path.basename(d) for d in shard_dirs]
+        }
+        if shard_by == 'bytes':
+            manifest["range"] = [start, end]
+        # written last, marking the shard as complete
+        with open(os.path.join(out_file, 'manifest.json.tmp'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(os.path.join(out_file, 'manifest.json.tmp'), os.path.join(out_file, 'manifest.json'))
+
+    if unordered and merge:
+        merge_start = default_timer()
+        output = OutputSplitter(NextFile(out_file), file_size, file_compress)
+        count = merge_shards(shard_dirs, output)
+        output.close()
+        for shard_dir in shard_dirs:
+            shutil.rmtree(shard_dir)
+        logging.info("Merged %d articles from %d shards in %.1fs", count, len(shard_dirs),
+                     default_timer() - merge_start)
+
 
-    # process pages
-    logging.info("Starting page extraction from %s.", input_file)
-    extract_start = default_timer()
+def page_entry(id: str, timestamp: str, title: str, page: list[str]) -> Optional[dict[str, Any]]:
+    """
+    Build the entry of pages2ids.jsonl for a page.
+    :return: the entry, or None for disambiguation pages, which are skipped.
+    """
+    source = ''.join(page).strip()
+
+    find_disambig = disambiguation_pattern.search(source)
+    if find_disambig:
+        return None
+
+    redirect_title = None
+    for curr_redirect_pattern in redirect_patterns:
+        result_pattern = curr_redirect_pattern.search(source)
+        if result_pattern:
+            redirect_title = html.unescape(result_pattern.group(1))
+            break
+
+    return {
+        "id": id, "timestamp": timestamp, "title": html.unescape(title),
+        "redirect": redirect_title
+    }
+
+
+def dispatch_pages(pages: Iterator[tuple[str, str, str, str, list[str]]], urlbase: str,
+                   jobs_queue: Queue, select: Optional[Callable[[str], bool]] = None,
+                   positions: Optional[list[int]] = None) -> tuple[int, list[dict[str, Any]]]:
+    """
+    Send the articles among :param pages: to :param jobs_queue:, in batches
+    (first ordinal, [(id, revid, timestamp, urlbase, title, page), ...]).
+    :param select: if given, only the pages whose id it accepts are considered.
+    :param positions: if given, the position among :param pages: of each
+        entry of pages2ids is appended to it.
+    :return: the number of articles and the entries of pages2ids.
+    """
+    ordinal = 0  # page count
+    pages2ids = []
+    # jobs are sent in batches of consecutive pages, to reduce queue overhead
+    batch: list[tuple[str, str, str, str, str, list[str]]] = []
+    batch_bytes = 0
+    for position, (id, revid, timestamp, title, page) in enumerate(pages):
+        if select and not select(id):
+            continue
+        entry = page_entry(id, timestamp, title, page)
+        if not entry:
+            continue
+        pages2ids.append(entry)
+        if positions is not None:
+            positions.append(position)
+        if not entry['redirect']:
+            size = sum(map(len, page))
+            if batch and (size >= jobBatchBytes or batch_bytes + size > jobBatchBytes):
+                # large pages go alone
+                jobs_queue.put((ordinal - len(batch), batch))  # goes to any available extract_process
+                batch = []
+                batch_bytes = 0
+            batch.append((id, revid, timestamp, urlbase, title, page))
+            batch_bytes += size
+            ordinal += 1
+            if len(batch) >= jobBatchSize or batch_bytes >= jobBatchBytes:
+                jobs_queue.put((ordinal - len(batch), batch))
+                batch = []
+                batch_bytes = 0
+    if batch:
+        jobs_queue.put((ordinal - len(batch), batch))
+
+    return ordinal, pages2ids
 
+
+def map_pages(pages: Iterator[tuple[str, str, str, str, list[str]]], urlbase: str,
+              output: Union[TextIO, OutputSplitter],
+              process_count: int, html_safe: bool, reorder_buffer: int = 0,
+              spill_dir: Optional[str] = None) -> tuple[int, list[dict[str, Any]]]:
+    """
+    Extract :param pages: in parallel, writing them in order to :param output:.
+    :param pages: tuples (id, revid, timestamp, title, page) as produced by collect_pages().
+    :param reorder_buffer: limit to the size of texts held waiting for earlier ones,
+        beyond which they are spilled to disk in :param spill_dir:.
+    :return: the number of articles extracted and the entries of pages2ids.
+    """
     # Parallel Map/Reduce:
     # - pages to be processed are dispatched to workers
     # - a reduce process collects the results, sort them and print them.
@@ -432,53 +1098,72 @@ def process_dump(input_file: str, template_file: str, out_file: str, file_size:
     output_queue: Queue = Queue(maxsize=maxsize)
 
     # Reduce job that sorts and prints output
-    reduce = Process(target=reduce_process, args=(output_queue, output))
+    reduce = Process(target=reduce_process, args=(output_queue, output, reorder_buffer, spill_dir))
     reduce.start()
 
     # initialize jobs queue
     jobs_queue: Queue = Queue(maxsize=maxsize)
+    stats_queue: Queue = Queue()
 
     # start worker processes
     logging.info("Using %d extract processes.", process_count)
     workers = []
     for _ in range(max(1, process_count)):
         extractor = Process(target=extract_process,
-                            args=(jobs_queue, output_queue, html_safe))
+                            args=(jobs_queue, output_queue, html_safe, stats_queue))
         extractor.daemon = True  # only live while parent process lives
         extractor.start()
         workers.append(extractor)
 
     # Mapper process
+    ordinal, pages2ids = dispatch_pages(pages, urlbase, jobs_queue)
 
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
+    # signal termination
+    for _ in workers:
+        jobs_queue.put(None)
+    # wait for workers to terminate
+    for w in workers:
+        w.join()
+    log_cache_stats([stats_queue.get() for w in workers if w.exitcode == 0])
 
-    ordinal = 0  # page count
-    pages2ids = []
-    for id, revid, timestamp, title, page in collect_pages(input):
-        source = ''.join(page).strip()
+    # signal end of work to reduce process
+    output_queue.put(None)
+    # wait for it to finish
+    reduce.join()
 
-        find_disambig = disambiguation_pattern.search(source)
-        if find_disambig:
-            continue
+    return ordinal, pages2ids
 
-        redirect_title = None
-        for curr_redirect_pattern in redirect_patterns:
-            result_pattern = curr_redirect_pattern.search(source)
-            if result_pattern:
-                redirect_title = html.unescape(result_pattern.group(1))
-                break
 
-        pages2ids.append({
-            "id": id, "timestamp": timestamp, "title": html.unescape(title),
-            "redirect": redirect_title
-        })
-        if not redirect_title:
-            job = (id, revid, timestamp, urlbase, title, page, ordinal)
-            jobs_queue.put(job)  # goes to any available extract_process
-            ordinal += 1
+def map_shards(pages: Iterator[tuple[str, str, str, str, list[str]]], urlbase: str,
+               out_file: str, file_size: int, file_compress: bool,
+               process_count: int, html_safe: bool, select: Optional[Callable[[str], bool]] = None,
+               positions: Optional[list[int]] = None) -> tuple[int, list[dict[str, Any]], list[str]]:
+    """
+    Extract :param pages: in parallel, each process writing the texts
+    it extracts to its own shard, a directory in :param out_file:,
+    without restoring the order of the dump.
+    :param select, positions: as in dispatch_pages().
+    :return: the number of articles extracted, the entries of pages2ids and
+        the shard directories.
+    """
+    Process = get_context("fork").Process
 
-    input.close()
+    jobs_queue: Queue = Queue(maxsize=10 * process_count)
+    stats_queue: Queue = Queue()
+
+    logging.info("Using %d extract processes writing separate shards.", process_count)
+    workers = []
+    shard_dirs = []
+    for i in range(max(1, process_count)):
+        shard_dir = os.path.join(out_file, 'shard%02d' % i)
+        extractor = Process(target=shard_process,
+                            args=(jobs_queue, html_safe, shard_dir, file_size, file_compress, stats_queue))
+        extractor.daemon = True  # only live while parent process lives
+        extractor.start()
+        workers.append(extractor)
+        shard_dirs.append(shard_dir)
+
+    ordinal, pages2ids = dispatch_pages(pages, urlbase, jobs_queue, select, positions)
 
     # signal termination
     for _ in workers:
@@ -486,74 +1171,355 @@ def process_dump(input_file: str, template_file: str, out_file: str, file_size:
     # wait for workers to terminate
     for w in workers:
         w.join()
+    log_cache_stats([stats_queue.get() for w in workers if w.exitcode == 0])
 
-    # signal end of work to reduce process
-    output_queue.put(None)
-    # wait for it to finish
-    reduce.join()
+    return ordinal, pages2ids, shard_dirs
 
-    if output != sys.stdout:
-        output.close()
-    extract_duration = default_timer() - extract_start
-    extract_rate = ordinal / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)", process_count, ordinal, extract_duration, extract_rate)
 
-    with open(os.path.join(out_file, 'pages2ids.jsonl'), 'w', encoding='utf-8') as f:
-        # write pages2ids as json
-        for page2id in pages2ids:
-            f.write(json.dumps(page2id, ensure_ascii=False)+'\n')
+def read_shards(shard_dirs: list[str]) -> Iterator[str]:
+    """
+    :return: the texts in the shards written by shard_process(), in the
+        order of the dump.
+    """
+    def documents(shard_dir: str) -> Iterator[tuple[int, str]]:
+        # files are named in alphabetical order
+        filenames = iter(sorted(glob.glob(os.path.join(shard_dir, '*', 'wiki_*'))))
+        file: Optional[IO[str]] = None
+        with open(os.path.join(shard_dir, 'index')) as index:
+            for line in index:
+                ordinal, length = map(int, line.split())
+                text = file.read(length) if file else ''
+                while len(text) < length:  # at the end of the file, move to the next one
+                    if file:
+                        file.close()
+                    filename = next(filenames)
+                    if filename.endswith('.bz2'):
+                        file = bz2.open(filename, 'rt', encoding='utf-8', newline='')
+                    else:
+                        file = open(filename, encoding='utf-8', newline='')
+                    text = file.read(length)
+                yield ordinal, text
+        if file:
+            file.close()
+
+    for _, text in heapq.merge(*(documents(d) for d in shard_dirs)):
+        yield text
+
+
+def merge_shards(shard_dirs: list[str], output: Union[TextIO, OutputSplitter]) -> int:
+    """
+    Write to :param output: the texts in the shards written by shard_process(),
+    in the order of the dump.
+    :return: the number of texts written.
+    """
+    count = 0
+    for text in read_shards(shard_dirs):
+        output.write(text)
+        count += 1
+    return count
+
+
+# ----------------------------------------------------------------------
+# Extraction on several nodes
+
+def dump_shard_dir(out_file: str, shard: int, shards: int) -> str:
+    """
+    :return: the directory in :param out_file: where a node extracting
+        :param shard: of :param shards: writes its output.
+    """
+    return os.path.join(out_file, 'shard-%d-of-%d' % (shard, shards))
+
+
+def merge_dump_shards(out_file: str, file_size: int, file_compress: bool) -> int:
+    """
+    Merge the output of the nodes of a sharded extraction (see --shard),
+    written to subdirectories of :param out_file:, into the same files and
+    pages2ids.jsonl that a single extraction would have written there.
+    The shard directories are removed afterwards.
+    :param file_size: max size of each extracted file.
+    :param file_compress: whether to compress files with bzip.
+    :return: the number of articles.
+    :raise ValueError: if some shard is missing or incomplete, or shards of
+        different extractions are mixed.
+    """
+    manifests: dict[int, dict[str, Any]] = {}
+    for filename in glob.glob(os.path.join(out_file, 'shard-*-of-*', 'manifest.json')):
+        with open(filename) as f:
+            manifest = json.load(f)
+        manifest['dir'] = os.path.dirname(filename)
+        manifests[manifest['shard']] = manifest
+    if not manifests:
+        raise ValueError("no complete shards in '%s'" % out_file)
+    first = next(iter(manifests.values()))
+    for manifest in manifests.values():
+        for key in ('input', 'size', 'shards', 'by'):
+            if manifest[key] != first[key]:
+                raise ValueError("shards of different extractions in '%s': %s differs in %s" %
+                                 (out_file, key, manifest['dir']))
+    missing = [k for k in range(1, first['shards'] + 1) if k not in manifests]
+    if missing:
+        raise ValueError("shards %s of %d missing or incomplete in '%s'" %
+                         (','.join(map(str, missing)), first['shards'], out_file))
+
+    def entries(manifest: dict[str, Any]) -> Iterator[tuple[tuple[int, int], str, Optional[str]]]:
+        # byte ranges follow each other, while pages selected by id are
+        # positioned within the whole dump
+        rank = manifest['shard'] if manifest['by'] == 'bytes' else 0
+        texts = read_shards([os.path.join(manifest['dir'], part) for part in manifest['parts']])
+        with open(os.path.join(manifest['dir'], 'pages2ids.jsonl'), encoding='utf-8') as lines, \
+             open(os.path.join(manifest['dir'], 'positions')) as positions:
+            for line, position in zip(lines, positions):
+                text = None if json.loads(line)['redirect'] else next(texts)
+                yield (rank, int(position)), line, text
+
+    count = 0
+    output = OutputSplitter(NextFile(out_file), file_size, file_compress)
+    with open(os.path.join(out_file, 'pages2ids.jsonl'), 'w', encoding='utf-8') as pages2ids:
+        for _, line, text in heapq.merge(*(entries(m) for m in manifests.values()),
+                                         key=lambda entry: entry[0]):
+            pages2ids.write(line)
+            if text is not None:
+                output.write(text)
+                count += 1
+    output.close()
+    for manifest in manifests.values():
+        shutil.rmtree(manifest['dir'])
+    return count
+
+
+def map_ranges(input_file: str, urlbase: str, output: Union[TextIO, OutputSplitter],
+               process_count: int, html_safe: bool, spool_dir: str) -> tuple[int, list[dict[str, Any]]]:
+    """
+    Extract the pages of an uncompressed dump splitting it into byte ranges,
+    each of which is scanned and extracted by a separate process.
+    The documents of each range are spooled to a file in :param spool_dir:
+    and then copied in order to :param output:.
+    :return: the number of articles extracted and the entries of pages2ids.
+    """
+    ranges = page_ranges(input_file, 4 * max(1, process_count))  # for balancing load
+    logging.info("Using %d extract processes on %d byte ranges.", process_count, len(ranges))
+    tasks = [(input_file, start, end, urlbase, html_safe, os.path.join(spool_dir, 'range_%04d' % i))
+             for i, (start, end) in enumerate(ranges)]
+    interval_start = default_timer()
+    period = 100000
+    ordinal = 0
+    pages2ids = []
+    stats = []
+    pool = get_context("fork").Pool(max(1, process_count))
+    for task, (_, entries, cache_stats) in zip(tasks, pool.imap(extract_range, tasks)):
+        pages2ids.extend(entries)
+        stats.append(cache_stats)
+        spool_file = task[-1]
+        for record in read_records(spool_file):
+            output.write(record.decode('utf-8'))
+            ordinal += 1
+            # progress report
+            if ordinal % period == 0:
+                interval_rate = period / (default_timer() - interval_start)
+                logging.info("Extracted %d articles (%.1f art/s)", ordinal, interval_rate)
+                interval_start = default_timer()
+        os.remove(spool_file)
+    pool.close()
+    pool.join()
+    log_cache_stats(stats)
+    return ordinal, pages2ids
 
 # ----------------------------------------------------------------------
 # Multiprocess support
 
+##
+# Maximum number of pages in a batch of jobs sent to extract processes.
+jobBatchSize = 100
+
+##
+# Maximum size in characters of a batch of jobs: larger pages are sent alone.
+jobBatchBytes = 256 * 1024
 
-def extract_process(jobs_queue: Queue, output_queue: Queue, html_safe: bool) -> None:
-    """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
+
+def extract_range(task: tuple[str, int, int, str, bool, str]) -> tuple[int, list[dict[str, Any]], dict[str, Any]]:
+    """
+    Scan and extract the pages in a byte range of an uncompressed dump.
+    :param task: a tuple (input_file, start, end, urlbase, html_safe, spool_file),
+        where spool_file is the file where to write extracted documents.
+    :return: the number of documents extracted, the entries of pages2ids
+        and the statistics of the caches for the range.
+    """
+    input_file, start, end, urlbase, html_safe, spool_file = task
+    count = 0
+    pages2ids = []
+    input = range_open(input_file, start, end)
+    with open(spool_file, 'wb') as spool:
+        for id, revid, timestamp, title, page in collect_pages(input):
+            entry = page_entry(id, timestamp, title, page)
+            if not entry:
+                continue
+            pages2ids.append(entry)
+            if not entry['redirect']:
+                out = StringIO()  # memory buffer
+                Extractor(id, revid, timestamp, urlbase, title, page).extract(out, html_safe)
+                write_record(spool, out.getvalue().encode('utf-8'))
+                count += 1
+    input.close()
+    save_parsed_templates()
+    return count, pages2ids, cache_stats(reset=True)
+
+
+def log_cache_stats(stats: list[dict[str, dict[str, int]]]) -> None:
+    """
+    Log the sum of the statistics of the caches of extract processes, and
+    of the stages of cleaning they skipped, as returned by cache_stats().
+    """
+    for name in ('templates', 'expansions'):
+        hits = sum(s[name]['hits'] for s in stats)
+        misses = sum(s[name]['misses'] for s in stats)
+        if hits + misses:
+            logging.info("Cache of %s: %d hits, %d misses (%.1f%% hit rate), %d evictions, "
+                         "up to %d entries per process", name, hits, misses, 100.0 * hits / (hits + misses),
+                         sum(s[name]['evictions'] for s in stats), max(s[name]['size'] for s in stats))
+    skipped: Counter = sum((Counter(s['stages']) for s in stats), Counter())
+    pages = skipped.pop('pages', 0)
+    if pages:
+        logging.info("Stages of cleaning skipped on %d pages: %s", pages,
+                     ', '.join('%s %d (%.1f%%)' % (stage, count, 100.0 * count / pages)
+                               for stage, count in sorted(skipped.items())) or 'none')
+
+
+def extract_process(jobs_queue: Queue, output_queue: Queue, html_safe: bool,
+                    stats_queue: Optional[Queue] = None) -> None:
+    """Pull batches of raw page content, do CPU/regex-heavy fixup, push finished text
     :param jobs_queue: where to get jobs.
     :param output_queue: where to queue extracted text for output.
     :html_safe: whether to convert entities in text to HTML.
+    :param stats_queue: where to queue the statistics of the caches at the end.
     """
     while True:
-        job = jobs_queue.get()  # job is (id, revid, urlbase, title, page)
+        job = jobs_queue.get()  # job is (ordinal, [(id, revid, timestamp, urlbase, title, page), ...])
         if job:
-            out = StringIO()  # memory buffer
-            Extractor(*job[:-1]).extract(out, html_safe)  # (id, urlbase, title, page)
-            text = out.getvalue()
-            output_queue.put((job[-1], text))  # (ordinal, extracted_text)
-            out.close()
+            ordinal, batch = job
+            texts = []
+            for page in batch:
+                out = StringIO()  # memory buffer
+                Extractor(*page).extract(out, html_safe)
+                texts.append(out.getvalue())
+                out.close()
+            output_queue.put((ordinal, texts))  # (first ordinal, extracted texts)
         else:
             break
+    save_parsed_templates()
+    if stats_queue:
+        stats_queue.put(cache_stats())
 
 
-def reduce_process(output_queue: Queue, output: Union[TextIO, IO[Any], GzipFile]) -> None:
+def shard_process(jobs_queue: Queue, html_safe: bool, shard_dir: str, file_size: int,
+                  file_compress: bool, stats_queue: Optional[Queue] = None) -> None:
+    """Pull batches of raw page content, do CPU/regex-heavy fixup, write finished
+    text to a series of files in :param shard_dir:, listing in file `index` there
+    the ordinal and the size of each text, in the order written.
+    :param jobs_queue: where to get jobs.
+    :html_safe: whether to convert entities in text to HTML.
+    :param file_size: max size of each file.
+    :param file_compress: whether to compress files with bzip.
+    :param stats_queue: where to queue the statistics of the caches at the end.
+    """
+    output = OutputSplitter(NextFile(shard_dir), file_size, file_compress)
+    with open(os.path.join(shard_dir, 'index'), 'w') as index:
+        while True:
+            job = jobs_queue.get()  # job is (ordinal, [(id, revid, timestamp, urlbase, title, page), ...])
+            if not job:
+                break
+            ordinal, batch = job
+            for page in batch:
+                out = StringIO()  # memory buffer
+                Extractor(*page).extract(out, html_safe)
+                text = out.getvalue()
+                output.write(text)
+                index.write('%d %d\n' % (ordinal, len(text)))
+                ordinal += 1
+                out.close()
+    output.close()
+    save_parsed_templates()
+    if stats_queue:
+        stats_queue.put(cache_stats())
+
+
+def reduce_process(output_queue: Queue, output: Union[TextIO, OutputSplitter], buffer_limit: int = 0,
+                   spill_dir: Optional[str] = None) -> None:
     """
     Pull finished article text, write series of files (or stdout)
-    :param output_queue: text to be output.
+    :param output_queue: batches of texts to be output, with the ordinal of the first one.
     :param output: file object where to print.
+    :param buffer_limit: maximum size in characters of the texts kept in
+        memory while waiting for earlier ones: further batches arriving out
+        of order are spilled to a temporary file. 0 means no limit.
+    :param spill_dir: directory where to create the spill file.
     """
 
     interval_start = default_timer()
     period = 100000
-    # FIXME: use a heap
-    ordering_buffer: dict[int, Any] = {}  # collected pages
+    # heap of batches arrived out of order: (first ordinal, texts, spill offset, size),
+    # where texts is None for batches spilled to disk.
+    ordering_buffer: list[tuple[int, Optional[list[str]], int, int]] = []
+    buffer_size = 0  # size of texts in memory
+    max_depth = 0
+    max_size = 0
+    spill: Optional[IO[bytes]] = None
+    spilled = 0  # spilled batches still in ordering_buffer
+    spilled_batches = 0
+    spilled_size = 0
     next_ordinal = 0  # sequence number of pages
     while True:
-        if next_ordinal in ordering_buffer:
-            output.write(ordering_buffer.pop(next_ordinal))
-            next_ordinal += 1
-            # progress report
-            if next_ordinal % period == 0:
-                interval_rate = period / (default_timer() - interval_start)
-                logging.info("Extracted %d articles (%.1f art/s)",
-                            next_ordinal, interval_rate)
-                interval_start = default_timer()
+        if ordering_buffer and ordering_buffer[0][0] == next_ordinal:
+            _, texts, offset, size = heapq.heappop(ordering_buffer)
+            if texts is None:
+                assert spill
+                spill.seek(offset)
+                texts = pickle.loads(read_record(spill))
+                spilled -= 1
+                if not spilled:
+                    spill.seek(0)
+                    spill.truncate()
+            else:
+                buffer_size -= size
+            for text in texts:
+                output.write(text)
+                next_ordinal += 1
+                # progress report
+                if next_ordinal % period == 0:
+                    interval_rate = period / (default_timer() - interval_start)
+                    logging.info("Extracted %d articles (%.1f art/s)",
+                                next_ordinal, interval_rate)
+                    interval_start = default_timer()
         else:
             # mapper puts None to signal finish
             pair = output_queue.get()
             if not pair:
                 break
-            ordinal, text = pair
-            ordering_buffer[ordinal] = text
+            ordinal, texts = pair
+            size = sum(map(len, texts))
+            if buffer_limit and ordinal != next_ordinal and buffer_size + size > buffer_limit:
+                if not spill:
+                    spill = tempfile.TemporaryFile(prefix='reorder', dir=spill_dir)
+                spill.seek(0, os.SEEK_END)
+                offset = spill.tell()
+                write_record(spill, pickle.dumps(texts, pickle.HIGHEST_PROTOCOL))
+                heapq.heappush(ordering_buffer, (ordinal, None, offset, size))
+                spilled += 1
+                spilled_batches += 1
+                spilled_size += size
+            else:
+                heapq.heappush(ordering_buffer, (ordinal, texts, 0, size))
+                buffer_size += size
+                max_size = max(max_size, buffer_size)
+            max_depth = max(max_depth, len(ordering_buffer))
+    if spill:
+        spill.close()
+    if isinstance(output, OutputSplitter):
+        output.close()
+    else:
+        output.flush()
+    logging.info("Reorder buffer held up to %d batches, %d characters in memory; "
+                 "%d batches, %d characters spilled to disk",
+                 max_depth, max_size, spilled_batches, spilled_size)
 
 
 # ----------------------------------------------------------------------
@@ -562,10 +1528,66 @@ def reduce_process(output_queue: Queue, output: Union[TextIO, IO[Any], GzipFile]
 minFileSize = 200 * 1024
 
 
+def parse_file_size(bytes: str) -> int:
+    """
+    :param bytes: a size like 100K or 1M, or 0 for a single article per file.
+    :raise ValueError: if invalid or below minFileSize.
+    """
+    power = 'kmg'.find(bytes[-1].lower()) + 1
+    # 0 bytes means put a single article per file.
+    file_size = 0 if bytes == '0' else int(bytes[:-1]) * 1024 ** power
+    if file_size and file_size < minFileSize:
+        raise ValueError()
+    return file_size
+
+
+def merge_main(argv: list[str]) -> None:
+    """
+    The merge sub-command, combining the output of a sharded extraction.
+    """
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + ' merge',
+                                     description="Merge the shards written to the output directory "
+                                     "by the nodes of an extraction with --shard K/N into the output "
+                                     "of a single extraction.")
+    parser.add_argument("output",
+                        help="directory with the extracted shards")
+    parser.add_argument("-b", "--bytes", default="1M",
+                        help="maximum bytes per output file (default %(default)s); 0 means to put a single article per file",
+                        metavar="n[KMG]")
+    parser.add_argument("-c", "--compress", action="store_true",
+                        help="compress output files using bzip")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="suppress reporting progress info")
+    args = parser.parse_args(argv)
+
+    FORMAT = '%(levelname)s: %(message)s'
+    logging.basicConfig(format=FORMAT)
+    if not args.quiet:
+        logging.getLogger().setLevel(logging.INFO)
+
+    try:
+        file_size = parse_file_size(args.bytes)
+    except ValueError:
+        logging.error('Insufficient or invalid size: %s', args.bytes)
+        return
+
+    merge_start = default_timer()
+    try:
+        count = merge_dump_shards(args.output, file_size, args.compress)
+    except ValueError as e:
+        logging.error('Cannot merge: %s', e)
+        sys.exit(1)
+    logging.info("Merged %d articles in %.1fs", count, default_timer() - merge_start)
+
+
 def main() -> None:
     global acceptedNamespaces
     global templateCache
 
+    if sys.argv[1:2] == ['merge']:
+        merge_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
                                     formatter_class=argparse.RawDescriptionHelpFormatter,
                                     description=__doc__)
@@ -581,6 +1603,16 @@ def main() -> None:
                         help="compress output files using bzip")
     groupO.add_argument("--json", action="store_true",
                         help="write output in json format instead of the default <doc> format")
+    groupO.add_argument("--unordered", action="store_true",
+                        help="let each process write its own shard of files, in a subdirectory of the output, "
+                        "not in the order of the dump")
+    groupO.add_argument("--merge-shards", action="store_true",
+                        help="with --unordered, merge the shards in the order of the dump at the end")
+    groupO.add_argument("--shard", default=None, metavar="K/N",
+                        help="extract only the K-th of N slices of the dump, to a subdirectory of the output "
+                        "with a manifest; once all N are done, combine them with: %(prog)s merge OUTPUT")
+    groupO.add_argument("--shard-by", choices=['bytes', 'id'], default='bytes',
+                        help="slice the dump by byte ranges, for uncompressed dumps, or by page id (default %(default)s)")
 
     groupP = parser.add_argument_group('Processing')
     groupP.add_argument("--html", action="store_true",
@@ -590,14 +1622,44 @@ def main() -> None:
     groupP.add_argument("-ns", "--namespaces", default=None, metavar="FILE",
                         help="accepted namespaces")
     groupP.add_argument("--templates",
-                        help="use or create file containing templates")
+                        help="use or create file containing templates, rebuilt if the dump changes")
     groupP.add_argument("--no-templates", action="store_true",
                         help="Do not expand templates")
+    groupP.add_argument("--lazy-templates", action="store_true",
+                        help="process the definition of templates only when they are first used")
+    groupP.add_argument("--parse-cache", metavar="FILE",
+                        help="keep parsed templates in FILE, to reuse in later runs")
+    groupP.add_argument("--fold-templates", action="store_true",
+                        help="expand once, before extraction, the templates that do not depend "
+                        "on parameters or on the page")
+    groupP.add_argument("--template-cache-size", type=int, default=templateCacheSize, metavar="N",
+                        help="maximum number of parsed templates cached by each process "
+                        "(default %(default)s); 0 means no limit")
+    groupP.add_argument("--expansion-cache-size", type=int, default=expansionCacheSize, metavar="N",
+                        help="maximum number of template expansions cached by each process, for reuse "
+                        "in other calls with the same parameters (default %(default)s); 0 disables it")
+    groupP.add_argument("--expansion-timeout", type=float, default=Extractor.expansionTimeout, metavar="SECONDS",
+                        help="maximum time spent expanding the templates of a page, before dropping them; "
+                        "the output then depends on the speed of the machine (default no limit)")
+    groupP.add_argument("--max-expansion-nodes", type=int, default=Extractor.maxExpansionNodes, metavar="N",
+                        help="maximum number of template and parameter expansions in a page (default %(default)s)")
     groupP.add_argument("--html-safe", default=True,
                         help="use to produce HTML safe output within <doc>...</doc>")
     default_process_count = cpu_count() - 1
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    parser.add_argument("--decompress-processes", type=int, default=0, metavar="N",
+                        help="decompress a multistream bz2 dump with N processes (default: sequentially)")
+    parser.add_argument("--multistream-index", default=None, metavar="FILE",
+                        help="index file of a multistream bz2 dump (default: looked up next to the dump, "
+                        "or stream boundaries are found by scanning it)")
+    parser.add_argument("--byte-ranges", action="store_true",
+                        help="split an uncompressed dump into byte ranges, parsed and extracted by separate processes")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="read the dump only once, saving pages to a local spill file while collecting templates")
+    parser.add_argument("--reorder-buffer", default="512M", metavar="n[KMG]",
+                        help="maximum size of extracted text held in memory to restore the dump order, "
+                        "beyond which it is spilled to disk (default %(default)s); 0 means no limit")
 
     groupS = parser.add_argument_group('Special')
     groupS.add_argument("-q", "--quiet", action="store_true",
@@ -617,17 +1679,35 @@ def main() -> None:
     if args.html:
         Extractor.keepLinks = True
     Extractor.to_json = args.json
+    Extractor.expansionTimeout = args.expansion_timeout
+    Extractor.maxExpansionNodes = args.max_expansion_nodes
+    templateCache.maxsize = args.template_cache_size
+    expansionCache.maxsize = args.expansion_cache_size
 
     try:
-        power = 'kmg'.find(args.bytes[-1].lower()) + 1
-        # 0 bytes means put a single article per file.
-        file_size = 0 if args.bytes == '0' else int(args.bytes[:-1]) * 1024 ** power
-        if file_size and file_size < minFileSize:
-            raise ValueError()
+        file_size = parse_file_size(args.bytes)
     except ValueError:
         logging.error('Insufficient or invalid size: %s', args.bytes)
         return
 
+    try:
+        power = 'kmg'.find(args.reorder_buffer[-1].lower()) + 1
+        reorder_buffer = int(args.reorder_buffer[:-1] if power else args.reorder_buffer) * 1024 ** power
+    except ValueError:
+        logging.error('Invalid size: %s', args.reorder_buffer)
+        return
+
+    shard = None
+    if args.shard:
+        try:
+            k, n = map(int, args.shard.split('/'))
+            if not 1 <= k <= n:
+                raise ValueError()
+            shard = (k, n)
+        except ValueError:
+            logging.error('Invalid shard: %s', args.shard)
+            return
+
     if args.namespaces:
         import json
         acceptedNamespaces = list(set(json.load(open(args.namespaces))))
@@ -654,8 +1734,11 @@ def main() -> None:
     if args.article:
         if args.templates:
             if os.path.exists(args.templates):
-                with open(args.templates) as file:
-                    load_templates(file)
+                if is_template_cache(args.templates):
+                    use_template_cache(TemplateCache(args.templates))
+                else:
+                    with open(args.templates) as file:
+                        load_templates(file)
 
         urlbase = ''
         with open(input_file) as input:
@@ -664,6 +1747,9 @@ def main() -> None:
         return
 
     output_path = args.output
+    if shard and output_path == '-':
+        logging.error('Sharded extraction requires an output directory')
+        return
     if output_path != '-' and not os.path.isdir(output_path):
         try:
             os.makedirs(output_path)
@@ -672,7 +1758,11 @@ def main() -> None:
             return
 
     process_dump(input_file, args.templates, output_path, file_size,
-                args.compress, args.processes, args.html_safe, not args.no_templates)
+                args.compress, args.processes, args.html_safe, not args.no_templates,
+                args.decompress_processes, args.multistream_index, args.byte_ranges,
+                args.single_pass, reorder_buffer, args.unordered, args.merge_shards,
+                shard, args.shard_by, args.lazy_templates, args.parse_cache,
+                args.fold_templates)
 
 if __name__ == '__main__':
     main()
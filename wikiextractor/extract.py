@@ -18,16 +18,25 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # =============================================================================
 
+import hashlib
 import html
 import json
 import logging
+import marshal
+import os
 import re
+import shutil
+import tempfile
 import time
-from html.entities import name2codepoint
-from typing import Any, Callable, Iterable, Iterator, Optional, TextIO
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from html.entities import html5, name2codepoint
+from itertools import accumulate, chain, count
+from typing import Any, Callable, Iterable, Iterator, Optional, TextIO, Union
 from urllib.parse import quote as urlencode
 
-from bs4 import BeautifulSoup
+
+from .templatestore import TemplateCache, TemplateStore
 
 # ----------------------------------------------------------------------
 
@@ -83,6 +92,12 @@ def get_url(urlbase: str, uid: str) -> str:
 substWords = 'subst:|safesubst:'
 
 
+class ExpansionBudgetExceeded(Exception):
+    """
+    Raised when template expansion of a page exceeds one of its budgets.
+    """
+
+
 class Extractor():
     """
     An extraction task on a article.
@@ -109,6 +124,18 @@ class Extractor():
 
     acceptedNamespaces = ['w', 'wiktionary', 'wikt', 'wikipedia', 'Wikipedia']
 
+    ##
+    # Expansion budgets per page, like those of MediaWiki: pages exceeding
+    # them are cleaned dropping templates instead of expanding them.
+    # Maximum number of template invocations and parameter substitutions.
+    maxExpansionNodes = 1000000
+    # Maximum total size of the expansions of templates in the page text.
+    maxIncludeSize = 2 * 1024 * 1024
+    # Maximum time in seconds spent expanding templates, 0 for no limit.
+    # Off by default, since it makes the output depend on the load of the
+    # machine, while the budgets above bound the work deterministically.
+    expansionTimeout = 0.0
+
     def __init__(self, id: str, revid: str, timestamp: str, urlbase: str, title: str, page: list[str]) -> None:
         """
         :param page: a list of lines.
@@ -121,10 +148,16 @@ class Extractor():
         self.page = page
         self.magicWords = MagicWords()
         self.frame: list[tuple[str, Any]] = []
+        self.frame_depth = 0  # deepest frame of the current expansion
         self.recursion_exceeded_1_errs = 0  # template recursion within expandTemplates()
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        self.expansion_nodes = 0
+        self.include_size = 0
+        self.expansion_deadline = 0.0
+        # whether the current expansion depends on the page, see expandTemplate()
+        self.depends_on_page = False
 
     def clean_text(self, text: str, mark_headers: bool = False, expand_templates: bool = True,
                 html_safe: bool = True) -> list[str]:
@@ -132,6 +165,15 @@ class Extractor():
         :param mark_headers: True to distinguish headers from paragraphs
         e.g. "## Section 1"
         """
+        self.set_magic_words()
+
+        text = clean(self, text, expand_templates=expand_templates,
+                    html_safe=html_safe, namespaces=self.acceptedNamespaces)
+
+        texts = compact(text, mark_headers=mark_headers)
+        return texts
+
+    def set_magic_words(self) -> None:
         self.magicWords['namespace'] = self.title[:max(0, self.title.find(":"))]
         #self.magicWords['namespacenumber'] = '0' # for article, 
         self.magicWords['pagename'] = self.title
@@ -142,12 +184,6 @@ class Extractor():
         self.magicWords['currenthour'] = time.strftime('%H')
         self.magicWords['currenttime'] = time.strftime('%H:%M:%S')
 
-        text = clean(self, text, expand_templates=expand_templates,
-                    html_safe=html_safe, namespaces=self.acceptedNamespaces)
-
-        texts = compact(text, mark_headers=mark_headers)
-        return texts
-
     def extract(self, out: TextIO, html_safe: bool=True) -> None:
         """
         :param out: a memory file.
@@ -218,22 +254,53 @@ class Extractor():
         # Test template expansion at:
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
 
-        res = ''
+        # look for matching {{...}}, and those nested in them, in one scan
+        nodes = parse_braces(wikitext)
+        if nodes is None:
+            nodes = [BraceNode(s, 0, e) for s, e in findMatchingBraces(wikitext, 2)]
+        return self.expandSpan(wikitext, 0, len(wikitext), nodes)
+
+    def expandSpan(self, text: str, start: int, end: int, nodes: list['BraceNode']) -> str:
+        """
+        Expand text[start:end], containing the templates :param nodes:,
+        as expandTemplates() would.
+        """
         if len(self.frame) >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            self.depends_on_page = True  # on the depth of the frame
+            return ''
 
         # logging.debug('<expandTemplates ' + str(len(self.frame)))
 
-        cur = 0
-        # look for matching {{...}}
-        for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
-            cur = e
+        res = []
+        cur = start
+        for node in nodes:
+            if node.braces == 2:
+                expansion = self.expandTemplate('', text, node)
+            else:
+                expansion = self.expandTemplate(text[node.start + 2:node.end - 2])
+            if not self.frame:  # included in the page text
+                self.include_size += len(expansion)
+                if self.include_size > self.maxIncludeSize:
+                    raise ExpansionBudgetExceeded('post-expand include size')
+            res.append(text[cur:node.start])
+            res.append(expansion)
+            cur = node.end
         # leftover
-        res += wikitext[cur:]
+        res.append(text[cur:end])
         # logging.debug('   expandTemplates> %d %s', len(self.frame), res)
-        return res
+        return ''.join(res)
+
+    def check_budget(self, nodes: int = 1) -> None:
+        """
+        Count :param nodes: expansion nodes and check the budgets of the page.
+        :raise ExpansionBudgetExceeded: if a budget is exceeded.
+        """
+        self.expansion_nodes += nodes
+        if self.expansion_nodes > self.maxExpansionNodes:
+            raise ExpansionBudgetExceeded('expansion node count')
+        if self.expansion_deadline and time.monotonic() > self.expansion_deadline:
+            raise ExpansionBudgetExceeded('expansion time')
 
     def templateParams(self, parameters: list[str]) -> dict[str, str]:
         """
@@ -307,9 +374,11 @@ class Extractor():
         logging.debug('   templateParams> %s', '|'.join(templateParams.values()))
         return templateParams
 
-    def expandTemplate(self, body: str) -> str:
+    def expandTemplate(self, body: str, text: str = '', node: Optional['BraceNode'] = None) -> str:
         """Expands template invocation.
         :param body: the parts of a template.
+        :param text, node: alternatively, the template in :param text: found
+            by parse_braces(), whose parts are expanded without scanning them.
 
         :see http://meta.wikimedia.org/wiki/Help:Expansion for an explanation
         of the process.
@@ -354,15 +423,35 @@ class Extractor():
 
         if len(self.frame) >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_2_errs += 1
+            self.depends_on_page = True
             # logging.debug('   INVOCATION> %d %s', len(self.frame), body)
             return ''
 
+        self.check_budget()
+
         logging.debug('INVOCATION %d %s', len(self.frame), body)
 
-        parts = splitParts(body)
+        if node is None:
+            parts = splitParts(body)
+            spans: list[tuple[int, int, list[BraceNode]]] = []
+        else:
+            spans = node.parts()
+            parts = []          # sliced only if needed
+
+        def expand(i: int, strip: bool = False) -> str:
+            # the expansion of part i, stripped of surrounding spaces
+            if node is None:
+                return self.expandTemplates(parts[i].strip() if strip else parts[i])
+            start, end, nodes = spans[i]
+            if strip:
+                while start < end and text[start].isspace():
+                    start += 1
+                while end > start and text[end - 1].isspace():
+                    end -= 1
+            return self.expandSpan(text, start, end, nodes)
+
         # title is the portion before the first |
-        logging.debug('TITLE %s', parts[0].strip())
-        title = self.expandTemplates(parts[0].strip())
+        title = expand(0, strip=True)
 
         # SUBST
         # Apply the template tag to parameters without
@@ -375,6 +464,8 @@ class Extractor():
             subst = True
 
         if title.lower() in self.magicWords.values:
+            if title.lower() in MagicWords.pageNames:
+                self.depends_on_page = True
             return self.magicWords[title.lower()]
 
         # Parser functions
@@ -383,31 +474,53 @@ class Extractor():
         colon = title.find(':')
         if colon > 1:
             funct = title[:colon]
+            if funct == '#invoke':
+                # it may use the parameters of any template in the frame
+                self.depends_on_page = True
+            if node is not None:
+                parts = [text[start:end] for start, end, _ in spans]
             parts[0] = title[colon + 1:].strip()  # side-effect (parts[0] not used later)
             # arguments after first are not evaluated
             ret = callParserFunction(funct, parts, self.frame)
+            if node is not None and '{{' in ret:
+                # usually one of the arguments, whose templates are known
+                for i in range(1, len(parts)):
+                    offset = parts[i].rfind(ret)
+                    if offset >= 0:
+                        start = spans[i][0] + offset
+                        end = start + len(ret)
+                        nodes = [n for n in spans[i][2] if n.end > start and n.start < end]
+                        if all(start <= n.start and n.end <= end for n in nodes):
+                            return self.expandSpan(text, start, end, nodes)
             return self.expandTemplates(ret)
 
-        title = fullyQualifiedTemplateTitle(title)
-        if not title:
+        if not title or title == ':':
             self.template_title_errs += 1
             return ''
 
-        redirected = redirects.get(title)
-        if redirected:
-            title = redirected
+        resolution = resolvedTitles.get(title)
+        if resolution is None:
+            resolution = resolve_template_title(title)
+        title, folded = resolution
+        if not title:
+            # The page being included could not be identified
+            return ''
+        if folded is not None:
+            # templates without parameters, expanded once by fold_constant_templates():
+            # charged as cached expansions
+            value, cost, depth = folded
+            if len(self.frame) + depth < self.maxTemplateRecursionLevels:
+                self.check_budget(cost)
+                self.frame_depth = max(self.frame_depth, len(self.frame) + depth)
+                return value
 
         # get the template
-        if title in templateCache:
-            template = templateCache[title]
-        elif title in templates:
-            template = Template.parse(templates[title])
+        template = templateCache.get(title)
+        if template is None:
+            definition = templates.get(title)
+            template = parse_template(template_body(rawTemplates[title]) if definition is None else definition)
             # add it to cache
             templateCache[title] = template
-            del templates[title]
-        else:
-            # The page being included could not be identified
-            return ''
 
         # logging.debug('TEMPLATE %s: %s', title, template)
 
@@ -439,13 +552,32 @@ class Extractor():
         #
         # :see: https://en.wikipedia.org/wiki/Help:Template#Handling_parameters
 
-        params = parts[1:]
-
         if not subst:
             # Evaluate parameters, since they may contain templates, including
             # the symbol "=".
             # {{#ifexpr: {{{1}}} = 1 }}
-            params = [self.expandTemplates(p) for p in params]
+            params = [expand(i) for i in range(1, len(parts) if node is None else len(spans))]
+        elif node is not None:
+            params = [text[start:end] for start, end, _ in spans[1:]]
+        else:
+            params = parts[1:]
+
+        # The expansion is a function of the template and of its parameters,
+        # unless it depends on the page, e.g. through {{PAGENAME}}.
+        key = (title, subst, *params)
+        cached = expansionCache.get(key) if expansionCache.maxsize else None
+        if cached is not None:
+            value, cost, depth = cached
+            # unless it would now exceed the recursion limit, charge the
+            # budget as expanding it again would
+            if len(self.frame) + depth < self.maxTemplateRecursionLevels:
+                self.check_budget(cost)
+                self.frame_depth = max(self.frame_depth, len(self.frame) + depth)
+                return value
+        outer_depends_on_page = self.depends_on_page
+        self.depends_on_page = False
+        outer_frame_depth = self.frame_depth
+        outer_expansion_nodes = self.expansion_nodes
 
         # build a dict of name-values for the parameter values
         params_dict = self.templateParams(params)
@@ -455,15 +587,71 @@ class Extractor():
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
         # 21637542 in enwiki.
         self.frame.append((title, params_dict))
+        self.frame_depth = len(self.frame)
         instantiated = template.subst(params_dict, self)
         # logging.debug('instantiated %d %s', len(self.frame), instantiated)
         value = self.expandTemplates(instantiated)
         self.frame.pop()
         # logging.debug('   INVOCATION> %s %d %s', title, len(self.frame), value)
+        if not self.depends_on_page and expansionCache.maxsize:
+            # with the nodes and the depth of frames its expansion took
+            expansionCache[key] = (value, self.expansion_nodes - outer_expansion_nodes,
+                                   self.frame_depth - len(self.frame))
+        self.depends_on_page |= outer_depends_on_page
+        self.frame_depth = max(self.frame_depth, outer_frame_depth)
         return value
 
 # ======================================================================
 
+##
+# The stages of clean() that can only change a text containing one of
+# these strings, by name.
+stagePreconditions = {
+    'templates': ('{{',),
+    'tables': ('{|',),
+    'external links': ('[',),
+    'internal links': ('[[',),
+    'magic words': ('__',),
+    'entities': ('&',),
+    'remaining entities': ('&',),
+    'quotes': ("''",),
+    'double quotes': ('""',),
+    'html entities': ('&',),
+    'move infoboxes': ('move_infobox',),
+    'tags': ('<',),
+    'placeholders': ('<',),
+    'spaces': ('  ',),
+    'dots': ('....',),
+    'escape': ('&', '<', '>'),
+}
+
+# Pages cleaned by this process, and stages skipped, by name
+stageCounts: Counter = Counter()
+
+
+def run_stage(stage: str, text: str) -> bool:
+    """
+    :return: whether :param text: meets the precondition of :param stage:
+        of clean(), otherwise counted as skipped.
+    """
+    for mark in stagePreconditions[stage]:
+        if mark in text:
+            return True
+    stageCounts[stage] += 1
+    return False
+
+
+def stage_stats(reset: bool = False) -> dict[str, int]:
+    """
+    :return: the number of pages cleaned by this process, as 'pages', and
+        of the times each stage of clean() was skipped.
+    :param reset: whether to reset the counters.
+    """
+    stats = dict(stageCounts)
+    if reset:
+        stageCounts.clear()
+    return stats
+
 
 def clean(extractor: Extractor, text: str, expand_templates: bool=False, html_safe: bool=True, namespaces: list[str] = []) -> str:
     """
@@ -476,95 +664,97 @@ def clean(extractor: Extractor, text: str, expand_templates: bool=False, html_sa
     @return: the cleaned text.
     """
 
+    stageCounts['pages'] += 1
     if expand_templates:
         # expand templates
         # See: http://www.mediawiki.org/wiki/Help:Templates
-        text = extractor.expandTemplates(text)
-    else:
+        extractor.expansion_nodes = 0
+        extractor.include_size = 0
+        extractor.expansion_deadline = time.monotonic() + extractor.expansionTimeout \
+            if extractor.expansionTimeout else 0.0
+        try:
+            text = extractor.expandTemplates(text)
+        except ExpansionBudgetExceeded as e:
+            logging.warning("Template expansion in article '%s' (%s) exceeded the %s budget: dropping templates",
+                            extractor.title, extractor.id, e)
+            extractor.frame = []
+            text = dropNested(text, r'{{', r'}}')
+    elif run_stage('templates', text):
         # Drop transclusions (template, parser functions)
         text = dropNested(text, r'{{', r'}}')
 
     # Drop tables
-    text = dropNested(text, r'{\|', r'\|}')
+    if run_stage('tables', text):
+        text = dropNested(text, r'{\|', r'\|}')
 
     # replace external links
-    text = replaceExternalLinks(text)
+    if run_stage('external links', text):
+        text = replaceExternalLinks(text)
 
     # replace internal links
-    text = replaceInternalLinks(text, namespaces=namespaces)
+    if run_stage('internal links', text):
+        text = replaceInternalLinks(text, namespaces=namespaces)
 
     # drop MagicWords behavioral switches
-    text = magicWordsRE.sub('', text)
+    if run_stage('magic words', text):
+        text = magicWordsRE.sub('', text)
 
     # ############### Process HTML ###############
 
     # turn into HTML, except for the content of <syntaxhighlight>
-    res = ''
-    cur = 0
-    for m in syntaxhighlight.finditer(text):
-        end = m.end()
-        res += unescape(text[cur:m.start()]) + m.group(1)
-        cur = end
-    text = res + unescape(text[cur:])
+    if run_stage('entities', text):
+        res = []
+        cur = 0
+        for m in syntaxhighlight.finditer(text):
+            res.append(unescape(text[cur:m.start()]))
+            res.append(m.group(1))
+            cur = m.end()
+        res.append(unescape(text[cur:]))
+        text = ''.join(res)
 
     # Handle bold/italic/quote
+    # (none of them makes "''" where there was none)
+    quotes = run_stage('quotes', text)
     if extractor.HtmlFormatting:
-        text = bold_italic.sub(r'<b>\1</b>', text)
-        text = bold.sub(r'<b>\1</b>', text)
-        text = italic.sub(r'<i>\1</i>', text)
+        if quotes:
+            text = bold_italic.sub(r'<b>\1</b>', text)
+            text = bold.sub(r'<b>\1</b>', text)
+            text = italic.sub(r'<i>\1</i>', text)
     else:
-        text = bold_italic.sub(r'\1', text)
-        text = bold.sub(r'\1', text)
-        text = italic_quote.sub(r'"\1"', text)
-        text = italic.sub(r'"\1"', text)
-        text = quote_quote.sub(r'"\1"', text)
+        if quotes:
+            text = bold_italic.sub(r'\1', text)
+            text = bold.sub(r'\1', text)
+            text = italic_quote.sub(r'"\1"', text)
+            text = italic.sub(r'"\1"', text)
+        if run_stage('double quotes', text):
+            text = quote_quote.sub(r'"\1"', text)
     # residuals of unbalanced quotes
-    text = text.replace("'''", '').replace("''", '"')
+    if quotes:
+        text = text.replace("'''", '').replace("''", '"')
 
     if extractor.HtmlFormatting:
-        # if there is any move_infobox in templates, then remove them with BeautifulSoup
-        soup = BeautifulSoup(text, 'html.parser')
-        for content in soup.find_all(['div']):
-            div_class = content.get('class')
-            if div_class and 'move_infobox' in div_class:
-                _ = content.extract()
-        text = str(soup)
-
-    # Collect spans
-    spans = []
-    # Drop HTML comments
-    for m in comment.finditer(text):
-        spans.append((m.start(), m.end()))
-
-    # Drop self-closing tags
-    for pattern in selfClosing_tag_patterns:
-        for m in pattern.finditer(text):
-            spans.append((m.start(), m.end()))
-
-    # Drop ignored tags
-    for left, right in ignored_tag_patterns:
-        for m in left.finditer(text):
-            spans.append((m.start(), m.end()))
-        for m in right.finditer(text):
-            spans.append((m.start(), m.end()))
-
-    # Bulk remove all spans
-    text = dropSpans(spans, text)
-
-    # Drop discarded elements
-    for tag in discardElements:
-        text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        if run_stage('html entities', text):
+            # Turn into text the references left (&amp;nbsp;)
+            text = unescapeHtmlText(text)
+        if run_stage('move infoboxes', text):
+            # drop the move_infobox produced by templates
+            text = dropMoveInfoboxes(text)
+
+    if run_stage('tags', text):
+        # Drop HTML comments, self-closing tags and ignored tags
+        text = dropSpans(tagSpans(text), text)
 
-    if not extractor.HtmlFormatting:
+        # Drop discarded elements
+        text = dropElements(text, discardElements)
+
+    if not extractor.HtmlFormatting and run_stage('remaining entities', text):
         # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
         text = unescape(text)
 
     # Expand placeholders
-    for pattern, placeholder in placeholder_tag_patterns:
-        index = 1
-        for match in pattern.finditer(text):
-            text = text.replace(match.group(), '%s_%d' % (placeholder, index))
-            index += 1
+    if run_stage('placeholders', text):
+        for pattern, placeholder in placeholder_tag_patterns:
+            text = replacePlaceholders(pattern, placeholder, text)
 
     text = text.replace('<<', u'«').replace('>>', u'»')
 
@@ -572,13 +762,15 @@ def clean(extractor: Extractor, text: str, expand_templates: bool=False, html_sa
 
     # Cleanup text
     text = text.replace('\t', ' ')
-    text = spaces.sub(' ', text)
-    text = dots.sub('...', text)
+    if run_stage('spaces', text):
+        text = spaces.sub(' ', text)
+    if run_stage('dots', text):
+        text = dots.sub('...', text)
     text = re.sub(u' (,:\.\)\]»)', r'\1', text)
     text = re.sub(u'(\[\(«) ', r'\1', text)
     text = re.sub(r'\n\W+?\n', '\n', text, flags=re.U)  # lines with only punctuations
     text = text.replace(',,', ',').replace(',.', '.')
-    if html_safe:
+    if html_safe and run_stage('escape', text):
         text = html.escape(text, quote=False)
     return text
 
@@ -759,15 +951,140 @@ def dropSpans(spans: list[tuple[int, int]], text: str) -> str:
     Drop from text the blocks identified in :param spans:, possibly nested.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
         if offset <= s:  # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return ''.join(res)
+
+
+def nestedSpans(opens: list[tuple[int, int, int, int]],
+                closes: list[tuple[int, int, int, int]]) -> list[tuple[int, int]]:
+    """
+    The spans that dropNested() drops, given the delimiters it would find.
+    :param opens: the open delimiters, as (start, end) in the text they are
+        matched against, followed by (start, end) in the text to drop from.
+    :param closes: the close delimiters, likewise.
+    :return: the spans to drop, in the latter text.
+    """
+    closeStarts = [c[0] for c in closes]
+
+    def searchClose(pos: int) -> Optional[int]:
+        i = bisect_left(closeStarts, pos)
+        return i if i < len(closes) else None
+
+    spans: list[tuple[int, int]] = []
+    nest = 0
+    if not opens:
+        return spans
+    start = 0
+    end = searchClose(opens[start][1])
+    next = start
+    while end is not None:
+        next += 1       # delimiters do not overlap: the next one follows
+        if next == len(opens):  # termination
+            while nest:  # close all pending
+                nest -= 1
+                if end + 1 == len(closes):
+                    break
+                end += 1
+            spans.append((opens[start][2], closes[end][3]))
+            break
+        while closes[end][1] < opens[next][0]:
+            if nest:
+                nest -= 1
+                if end + 1 == len(closes):  # unbalanced
+                    spans = [(spans[0][0] if spans else opens[start][2], closes[end][3])]
+                    end = None
+                    break
+                end += 1
+            else:
+                spans.append((opens[start][2], closes[end][3]))
+                start = next
+                end = searchClose(opens[next][1])
+                break
+        if next != start:
+            nest += 1
+    return spans
+
+
+# Matches the open and close tags of any element, as dropNested() does for
+# those in discardElements, and a '<' inside an open tag.
+elementTag = re.compile(r'<\s*(/\s*)?(\w+)(?(1)|[^<>/]*(<)?[^>/]*)>')
+
+
+def dropElements(text: str, tags: list[str]) -> str:
+    """
+    Drop from :param text: the elements with :param tags:, possibly nested,
+    as dropNested() does for each tag in turn, but finding the tags of all
+    of them in a single scan.
+    The spans of each tag are computed among the delimiters outside those
+    dropped for the previous tags, at their positions once those are dropped.
+    Since a drop could also join the text around it into a new delimiter,
+    or a delimiter could hold another one, the text is dropped from tag by
+    tag whenever a '<' is found inside a delimiter, or before a dropped span.
+    """
+    found: dict[str, tuple[list[tuple[int, int, int, int]], list[tuple[int, int, int, int]]]] = \
+        {tag: ([], []) for tag in tags}
+    safe = True
+    for m in elementTag.finditer(text):
+        close, name, inner = m.groups()
+        if inner:
+            safe = False
+            break
+        if not name.isascii():
+            if re.fullmatch('|'.join(tags), name, re.IGNORECASE) or name.lower() in found:
+                safe = False    # case folded by dropNested() other than by lower()
+                break
+            continue
+        delimiters = found.get(name.lower())
+        if delimiters is not None:
+            s, e = m.span()
+            delimiters[1 if close else 0].append((s, e, s, e))
+    if safe:
+        dropped: list[tuple[int, int]] = []  # disjoint, sorted
+        for tag in tags:
+            opens, closes = found[tag]
+            if not opens:
+                continue
+            if dropped:
+                # shift the delimiters outside the spans dropped so far
+                starts = [s for s, _ in dropped]
+                shifts = list(accumulate(e - s for s, e in dropped))
+
+                def shift(delimiters: list[tuple[int, int, int, int]]) -> list[tuple[int, int, int, int]]:
+                    shifted = []
+                    for s, e, _, _ in delimiters:
+                        i = bisect_right(starts, s) - 1
+                        if i < 0:
+                            shifted.append((s, e, s, e))
+                        elif dropped[i][1] <= s:
+                            shifted.append((s - shifts[i], e - shifts[i], s, e))
+                    return shifted
+                opens = shift(opens)
+                closes = shift(closes)
+            spans = nestedSpans(opens, closes)
+            if any(text.find('<', text.rfind('>', 0, s) + 1, s) >= 0 for s, _ in spans):
+                safe = False
+                break
+            if spans:
+                merged: list[tuple[int, int]] = []
+                for s, e in sorted(dropped + spans):
+                    if merged and s < merged[-1][1]:
+                        if e > merged[-1][1]:
+                            safe = False
+                        continue
+                    merged.append((s, e))
+                dropped = merged
+        if safe:
+            return dropSpans(dropped, text)
+    for tag in tags:
+        text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+    return text
 
 
 # ----------------------------------------------------------------------
@@ -799,10 +1116,10 @@ EXT_IMAGE_REGEX = re.compile(
 
 
 def replaceExternalLinks(text: str) -> str:
-    s = ''
+    s = []
     cur = 0
     for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur:m.start()]
+        s.append(text[cur:m.start()])
         cur = m.end()
 
         url = m.group(1)
@@ -826,9 +1143,10 @@ def replaceExternalLinks(text: str) -> str:
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        s.append(makeExternalLink(url, label))  # + trail
 
-    return s + text[cur:]
+    s.append(text[cur:])
+    return ''.join(s)
 
 
 def makeExternalLink(url: str, anchor: str) -> str:
@@ -864,7 +1182,7 @@ def replaceInternalLinks(text: str, namespaces: list[str]) -> str:
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
+    res = []
     for s, e in findBalanced(text, ['[['], [']]']):
         m = tailRE.match(text, e)
         if m:
@@ -889,9 +1207,12 @@ def replaceInternalLinks(text: str, namespaces: list[str]) -> str:
                     pipe = last  # advance
                 curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label, namespaces) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label, namespaces))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
 def makeInternalLink(title: str, label: str, namespaces: list[str]) -> str:
@@ -1000,6 +1321,42 @@ class MagicWords():
         'cascadingsources',
     ]
 
+    # names whose value depends on the page, rather than on the wiki or the run
+    pageNames = {
+        'pagename',
+        'pagenamee',
+        'fullpagename',
+        'fullpagenamee',
+        'namespace',
+        'namespacee',
+        'namespacenumber',
+        'pageid',
+        'revisionid',
+        'revisionday',
+        'revisionday2',
+        'revisionmonth',
+        'revisionmonth1',
+        'revisionyear',
+        'revisiontimestamp',
+        'revisionuser',
+        'revisionsize',
+        'subpagename',
+        'subpagenamee',
+        'talkspace',
+        'talkspacee',
+        'subjectspace',
+        'subjectspacee',
+        'talkpagename',
+        'talkpagenamee',
+        'subjectpagename',
+        'subjectpagenamee',
+        'rootpagename',
+        'rootpagenamee',
+        'basepagename',
+        'basepagenamee',
+        'cascadingsources',
+    }
+
     def __init__(self) -> None:
         self.values = {'!': '|'}
 
@@ -1155,32 +1512,185 @@ comment = re.compile(r'<!--.*?-->', re.DOTALL)
 # Match ignored tags
 ignored_tag_patterns = []
 
+# The patterns of self-closing and ignored tags, by lowercase tag name,
+# preceded by '/' for closing tags, tried by tagSpans() where such a tag
+# starts.
+tag_patterns_by_name: dict[str, list[re.Pattern[str]]] = {}
+# Those of tags that are not plain words, tried at each '<'.
+unnamed_tag_patterns: list[re.Pattern[str]] = []
+
+
+def indexTagPattern(tag: str, pattern: re.Pattern[str], closing: bool = False) -> None:
+    if tag.isascii() and re.fullmatch(r'\w+', tag):
+        tag_patterns_by_name.setdefault('/' * closing + tag.lower(), []).append(pattern)
+    else:
+        unnamed_tag_patterns.append(pattern)
+
 
 def ignoreTag(tag: str) -> None:
     left = re.compile(r'<%s\b.*?>' % tag, re.IGNORECASE | re.DOTALL)  # both <ref> and <reference>
     right = re.compile(r'</\s*%s>' % tag, re.IGNORECASE)
     ignored_tag_patterns.append((left, right))
+    indexTagPattern(tag, left)
+    indexTagPattern(tag, right, closing=True)
 
 
 def resetIgnoredTags() -> None:
     global ignored_tag_patterns
     ignored_tag_patterns = []
+    tag_patterns_by_name.clear()
+    unnamed_tag_patterns.clear()
+    for tag, pattern in zip(selfClosingTags, selfClosing_tag_patterns):
+        indexTagPattern(tag, pattern)
 
 
-for tag in ignoredTags:
-    ignoreTag(tag)
-
 # Match selfClosing HTML tags
 selfClosing_tag_patterns = [
     re.compile(r'<\s*%s\b[^>]*/\s*>' % tag, re.DOTALL | re.IGNORECASE) for tag in selfClosingTags
 ]
 
+resetIgnoredTags()
+for tag in ignoredTags:
+    ignoreTag(tag)
+
+# Match the start of a comment, or of a tag up to its name
+tagStart = re.compile(r'<(?:!--|\s*(/?)\s*(\w*))')
+
+
+def tagSpans(text: str) -> list[tuple[int, int]]:
+    """
+    :return: the spans of the comments, self-closing tags and ignored tags
+        in :param text:, as matched by each of their patterns, but looking
+        at each '<' once, for the patterns of the tag it starts.
+    """
+    spans = []
+    resume: dict[re.Pattern[str], int] = {}  # where each pattern resumes matching
+    for start in tagStart.finditer(text):
+        closing, name = start.groups()
+        if name is None:
+            patterns: Iterable[re.Pattern[str]] = (comment,)
+        elif name.isascii():
+            patterns = tag_patterns_by_name.get(closing + name.lower(), ())
+        else:  # the name might match ignoring case, other than by lower()
+            patterns = chain.from_iterable(tag_patterns_by_name.values())
+        if unnamed_tag_patterns:
+            patterns = chain(patterns, unnamed_tag_patterns)
+        pos = start.start()
+        for pattern in patterns:
+            if resume.get(pattern, 0) <= pos:
+                m = pattern.match(text, pos)
+                if m:
+                    spans.append(m.span())
+                    resume[pattern] = m.end()
+    return spans
+
+
 # Match HTML placeholder tags
 placeholder_tag_patterns = [
     (re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE),
     repl) for tag, repl in placeholder_tags.items()
 ]
 
+
+def replacePlaceholders(pattern: re.Pattern[str], placeholder: str, text: str) -> str:
+    """
+    Replace the matches of :param pattern: in :param text: with
+    :param placeholder: followed by their ordinal, or by that of their
+    first occurrence, for repeated ones.
+    """
+    placeholders: dict[str, str] = {}
+    index = count(1)
+
+    def replace(match: re.Match) -> str:
+        return placeholders.setdefault(match.group(), '%s_%d' % (placeholder, next(index)))
+
+    return pattern.sub(replace, text)
+
+
+# Match the start and end tags in HTML, with their name and attributes,
+# as html.parser finds them
+htmlTag = re.compile(r'''<(/?)([a-zA-Z][^\t\n\r\f />\x00]*)((?:"[^"]*"|'[^']*'|[^'">])*?)(/?)>''')
+# Match the class attribute of a tag
+classAttr = re.compile(r'''(?:^|\s)class\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*))''', re.IGNORECASE)
+
+##
+# HTML elements without content, which are never closed
+voidElements = frozenset((
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+    'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+    'spacer', 'track', 'wbr'))
+
+
+def dropMoveInfoboxes(text: str) -> str:
+    """
+    Drop from :param text: the divs of class move_infobox, with their
+    content, up to the matching </div>. Like an HTML parser, an unclosed div
+    ends with the element enclosing it, or at the end of the text.
+    """
+    spans: list[tuple[int, int]] = []
+    # the open elements, with the start of those to drop, or -1
+    stack: list[tuple[str, int]] = []
+    for m in htmlTag.finditer(text):
+        closing, name, attrs, selfClosing = m.groups()
+        name = name.lower()
+        if closing:
+            if any(open == name for open, _ in stack):
+                while True:
+                    open, start = stack.pop()
+                    if start >= 0:
+                        spans.append((start, m.end() if open == name else m.start()))
+                    if open == name:
+                        break
+            continue
+        start = -1
+        if name == 'div':
+            c = classAttr.search(attrs)
+            if c and 'move_infobox' in (c.group(1) or c.group(2) or c.group(3) or '').split():
+                start = m.start()
+        if selfClosing or name in voidElements:
+            if start >= 0:
+                spans.append((start, m.end()))
+        else:
+            stack.append((name, start))
+    spans.extend((start, len(text)) for _, start in stack if start >= 0)
+    return dropSpans(spans, text)
+
+
+# Match the tags and comments in HTML, as html.parser finds them
+htmlMarkup = re.compile(r'''<!--.*?-->|<[!?][^>]*>|</?[a-zA-Z](?:"[^"]*"|'[^']*'|[^'">])*>''', re.DOTALL)
+# Match a character reference, with the name of named ones
+charRef = re.compile(r'&(?:#[0-9]+|#[xX][0-9a-fA-F]+|([a-zA-Z][a-zA-Z0-9]*));?')
+
+
+def charRefText(m: re.Match) -> str:
+    """
+    :return: the character of the reference matched by charRef, or the
+        reference itself if it is unknown or it is one of &, < and >, which
+        would turn text into markup.
+    """
+    name = m.group(1)
+    if name:
+        text = html5.get(name + ';' if m.group().endswith(';') else name, m.group())
+    else:
+        text = html.unescape(m.group())
+    return m.group() if text in ('&', '<', '>') else text
+
+
+def unescapeHtmlText(text: str) -> str:
+    """
+    Decode the character references in the text of the HTML :param text:,
+    leaving tags, comments and the rest of the text as they are.
+    """
+    res = []
+    cur = 0
+    for m in htmlMarkup.finditer(text):
+        res.append(charRef.sub(charRefText, text[cur:m.start()]))
+        res.append(m.group())
+        cur = m.end()
+    res.append(charRef.sub(charRefText, text[cur:]))
+    return ''.join(res)
+
+
 # Match preformatted lines
 preformatted = re.compile(r'^ .*?$')
 
@@ -1224,6 +1734,20 @@ class Template(list):
         tpl.append(TemplateText(body[start:])) # leftover
         return tpl
 
+    def dump(self) -> list[Any]:
+        """
+        :return: the template as built-in objects, which marshal can save:
+            strings for TemplateTexts and pairs for TemplateArgs.
+        """
+        return [x.dump() if isinstance(x, TemplateArg) else str(x) for x in self]
+
+    @classmethod
+    def load(cls, data: list[Any]) -> 'Template':
+        """
+        :return: the template saved as :param data: by dump().
+        """
+        return Template([TemplateText(x) if type(x) is str else TemplateArg.load(x) for x in data])
+
     def subst(self, params: dict[str, str], extractor: Extractor, depth: int=0) -> str:
         # We perform parameter substitutions recursively.
         # We also limit the maximum number of iterations to avoid too long or
@@ -1282,6 +1806,16 @@ class TemplateArg():
             # This parameter has a default value
             self.default = Template.parse(parts[1])
 
+    def dump(self) -> tuple[list[Any], Optional[list[Any]]]:
+        return self.name.dump(), None if self.default is None else self.default.dump()
+
+    @classmethod
+    def load(cls, data: tuple[list[Any], Optional[list[Any]]]) -> 'TemplateArg':
+        arg = cls.__new__(cls)
+        arg.name = Template.load(data[0])
+        arg.default = None if data[1] is None else Template.load(data[1])
+        return arg
+
     def __str__(self) -> str:
         if self.default:
             return '{{{%s|%s}}}' % (self.name, self.default)
@@ -1296,6 +1830,7 @@ class TemplateArg():
         """
         # the parameter name itself might contain templates, e.g.:
         # appointe{{#if:{{{appointer14|}}}|r|d}}14|
+        extractor.check_budget()
         paramName = self.name.subst(params, extractor, depth+1)
         paramName = extractor.expandTemplates(paramName)
         res = ''
@@ -1351,34 +1886,19 @@ def splitParts(paramsList: str) -> list[str]:
 
     sep = '|'
     parameters: list[str] = []
+    start = 0  # of the current parameter
     cur = 0
-    for s, e in findMatchingBraces(paramsList):
-        par = paramsList[cur:s].split(sep)
-        if par:
-            if parameters:
-                # portion before | belongs to previous parameter
-                parameters[-1] += par[0]
-                if len(par) > 1:
-                    # rest are new parameters
-                    parameters.extend(par[1:])
-            else:
-                parameters = par
-        elif not parameters:
-            parameters = ['']  # create first param
-        # add span to last previous parameter
-        parameters[-1] += paramsList[s:e]
-        cur = e
-    # leftover
-    par = paramsList[cur:].split(sep)
-    if par:
-        if parameters:
-            # portion before | belongs to previous parameter
-            parameters[-1] += par[0]
-            if len(par) > 1:
-                # rest are new parameters
-                parameters.extend(par[1:])
-        else:
-            parameters = par
+    end = len(paramsList)
+    for s, e in chain(findMatchingBraces(paramsList), [(end, end)]):
+        # split at the separators before the span, which belongs to the
+        # last parameter
+        pos = paramsList.find(sep, cur, s)
+        while pos >= 0:
+            parameters.append(paramsList[start:pos])
+            start = pos + 1
+            pos = paramsList.find(sep, start, s)
+        cur = max(cur, e)
+    parameters.append(paramsList[start:])
 
     # logging.debug('splitParts %s %s\nparams: %s', sep, paramsList, str(parameters))
     return parameters
@@ -1493,6 +2013,104 @@ def findMatchingBraces(text: str, ldelim: int=0) -> Iterator[tuple[int, int]]:
                 cur = end
 
 
+# runs of braces or brackets, and bars, scanned by parse_braces()
+braceTokens = re.compile(r'\{{2,}|\}{2,}|\[{2,}|\]{2,}|\|')
+
+
+class BraceNode():
+    """
+    A template {{...}}, or a template argument {{{...}}}, found in a text
+    by parse_braces(), with those nested in it and the bars between its parts.
+    """
+    __slots__ = ('start', 'end', 'braces', 'bars', 'children')
+
+    def __init__(self, start: int, braces: int, end: int = 0) -> None:
+        """
+        :param braces: the number of braces, 2 or 3, or 0 if the content is
+            not parsed.
+        """
+        self.start = start
+        self.end = end
+        self.braces = braces
+        self.bars: list[int] = []   # positions of the bars separating its parts
+        self.children: list[BraceNode] = []
+
+    def parts(self) -> list[tuple[int, int, list['BraceNode']]]:
+        """
+        :return: the span of each part within the braces, and the nodes in it.
+        """
+        starts = [self.start + self.braces] + [bar + 1 for bar in self.bars]
+        ends = self.bars + [self.end - self.braces]
+        parts: list[tuple[int, int, list[BraceNode]]] = [(start, end, []) for start, end in zip(starts, ends)]
+        i = 0
+        for child in self.children:
+            while child.start > ends[i]:
+                i += 1
+            parts[i][2].append(child)
+        return parts
+
+
+def parse_braces(text: str) -> Optional[list[BraceNode]]:
+    """
+    Find in one scan the templates and template arguments in :param text:,
+    with those nested in them and the bars separating their parts, as
+    findMatchingBraces() and splitParts() find them scanning each part again.
+    :return: the outermost ones, or None if some braces are unbalanced or
+        ambiguous, like {{{{, and must be matched by findMatchingBraces().
+    """
+    if '{{' not in text:
+        return []
+    roots: list[BraceNode] = []
+    stack: list[Optional[BraceNode]] = []   # None for [[
+    for m in braceTokens.finditer(text):
+        token = m.group()
+        c = token[0]
+        if c == '|':
+            if stack and stack[-1] is not None:
+                stack[-1].bars.append(m.start())
+        elif c == '{':
+            if len(token) > 3:
+                return None
+            node = BraceNode(m.start(), len(token))
+            for parent in reversed(stack):
+                if parent is not None:
+                    parent.children.append(node)
+                    break
+            else:
+                roots.append(node)
+            stack.append(node)
+        elif c == '}':
+            # close the innermost ones, as long as there are braces
+            left = len(token)
+            end = m.start()
+            while stack:
+                closed = stack[-1]
+                if closed is None or left < closed.braces:
+                    return None     # closing [[ or only part of the braces
+                stack.pop()
+                left -= closed.braces
+                end += closed.braces
+                closed.end = end
+                if left <= 1:
+                    break
+            if left and stack:
+                return None         # a stray brace
+        elif c == '[':
+            # links matter only for the bars within templates
+            if stack:
+                if len(token) > 2:
+                    return None
+                stack.append(None)
+        else:
+            left = len(token)
+            while left >= 2 and stack and stack[-1] is None:
+                stack.pop()
+                left -= 2
+    if stack:
+        return None
+    return roots
+
+
 def findBalanced(text: str, openDelim: list[str], closeDelim: list[str]) -> Iterable[tuple[int, int]]:
     """
     Assuming that text contains a properly balanced expression using
@@ -1829,18 +2447,340 @@ def callParserFunction(functionName: str, args: list[str], frame: list[tuple[str
 
 reNoinclude = re.compile(r'<noinclude>(?:.*?)</noinclude>', re.DOTALL)
 reIncludeonly = re.compile(r'<includeonly>|</includeonly>', re.DOTALL)
+# matches the first line of a template that redirects to another
+reTemplateRedirect = re.compile(r'#REDIRECT.*?\[\[([^\]]*)]]', re.IGNORECASE)
 
 # These are built before spawning processes, hence they are shared.
-templates: dict[str, str] = {}
-redirects: dict[str, str] = {}
+# They are then frozen into memory mapped stores by freeze_templates(),
+# so that processes do not copy them by touching their reference counts.
+templates: Union[dict[str, str], TemplateStore] = {}
+redirects: Union[dict[str, str], TemplateStore] = {}
+# templates defined lazily, whose body is processed on first use
+rawTemplates: Union[dict[str, str], TemplateStore] = {}
+# expansions of templates that do not depend on parameters or on the page,
+# each preceded by a line with the number of expansion nodes and the depth
+# of frames it took
+foldedTemplates: Union[dict[str, str], TemplateStore] = {}
+
+
+class LRUCache():
+    """
+    Cache holding at most maxsize entries, which evicts the least recently
+    used ones, and counts hits, misses and evictions.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        """
+        :param maxsize: maximum number of entries; 0 for no limit.
+        """
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Any, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Any:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.maxsize and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self, reset: bool = False) -> dict[str, int]:
+        """
+        :return: the counters of hits, misses and evictions, and the size.
+        :param reset: whether to reset the counters.
+        """
+        stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                 'size': len(self.entries)}
+        if reset:
+            self.hits = self.misses = self.evictions = 0
+        return stats
+
+
+##
+# Maximum number of parsed templates cached by each process
+templateCacheSize = 10000
+
 # cache of parser templates
 # FIXME: sharing this with a Manager slows down.
-templateCache: dict[str, Template] = {}
+templateCache = LRUCache(templateCacheSize)
+
+##
+# Maximum number of template expansions cached by each process; 0 to disable
+expansionCacheSize = 10000
+
+# cache of the expansions of templates, by title and parameters, with the
+# number of expansion nodes and the depth of frames they took
+expansionCache = LRUCache(expansionCacheSize)
 
 
-def define_template(title: str, page: list[str]) -> None:
+##
+# Maximum number of titles in resolvedTitles, which is cleared when full
+resolvedTitlesSize = 100000
+
+# The templates included by {{title}} in this process: pairs of their title,
+# or '' if missing, and of their folded expansion, if any, with the number
+# of expansion nodes and the depth of frames it took
+resolvedTitles: dict[str, tuple[str, Optional[tuple[str, int, int]]]] = {}
+
+
+def resolve_template_title(title: str) -> tuple[str, Optional[tuple[str, int, int]]]:
+    """
+    Resolve the :param title: of a template call to the template it
+    includes, after redirects, adding it to resolvedTitles.
+    :return: the title of the template, or '' if there is none, and its
+        folded expansion, if any, with its cost in nodes and depth.
+    """
+    name = fullyQualifiedTemplateTitle(title)
+    name = redirects.get(name) or name
+    entry = foldedTemplates.get(name)
+    folded = None
+    if entry is not None:
+        counts, _, text = entry.partition('\n')
+        nodes, depth = map(int, counts.split())
+        folded = (text, nodes, depth)
+    elif name not in templates and name not in rawTemplates:
+        name = ''
+    if len(resolvedTitles) >= resolvedTitlesSize:
+        resolvedTitles.clear()
+    resolution = resolvedTitles[title] = (name, folded)
+    return resolution
+
+
+def resolve_redirects() -> int:
+    """
+    Make each redirect among templates point to the end of its chain of
+    redirects, dropping those within cycles.
+    To be called after loading templates.
+    :return: the number of redirects dropped.
+    """
+    global redirects
+
+    resolved = {}
+    for title, target in redirects.items():
+        seen = {title}
+        while target in redirects and target not in seen:
+            seen.add(target)
+            target = redirects[target]
+        if target not in seen:
+            resolved[title] = target
+    dropped = len(redirects) - len(resolved)
+    redirects = resolved
+    return dropped
+
+
+def cache_stats(reset: bool = False) -> dict[str, dict[str, int]]:
+    """
+    :return: the statistics of the caches of this process, and of the
+        stages of clean() it skipped.
+    :param reset: whether to reset the counters.
+    """
+    return {'templates': templateCache.stats(reset), 'expansions': expansionCache.stats(reset),
+            'stages': stage_stats(reset)}
+
+##
+# Version of the templates saved to the parse cache by Template.dump(),
+# to change when parsing changes.
+parseCacheVersion = 1
+
+# Cache across runs of parsed templates, by hash of their body, and the
+# directory where processes save those they parse (see open_parse_cache()).
+parseCache: Optional[TemplateStore] = None
+parseCacheDir: Optional[str] = None
+# templates parsed by this process, not yet saved
+parsedTemplates: dict[str, bytes] = {}
+
+
+def parse_template(body: str) -> Template:
+    """
+    Parse :param body:, unless it is in the parse cache.
+    """
+    if parseCacheDir is None:
+        return Template.parse(body)
+    key = hashlib.blake2b(body.encode('utf-8'), digest_size=16,
+                          person=b'%d' % parseCacheVersion).hexdigest()
+    data = parseCache.raw(key) if parseCache is not None else None
+    if data is not None:
+        return Template.load(marshal.loads(data))
+    template = Template.parse(body)
+    parsedTemplates[key] = marshal.dumps(template.dump())
+    return template
+
+
+def open_parse_cache(filename: str, dir: Optional[str] = None) -> None:
+    """
+    Use the parse cache :param filename:, if it exists, before spawning
+    processes, which save the templates they parse to a temporary
+    directory in :param dir:, to be added by update_parse_cache().
+    """
+    global parseCache
+    global parseCacheDir
+
+    if os.path.exists(filename):
+        with open(filename, 'rb') as file:
+            parseCache = TemplateStore(file)
+    parseCacheDir = tempfile.mkdtemp(prefix='parsed', dir=dir)
+
+
+def save_parsed_templates() -> None:
+    """
+    Save the templates parsed by this process for update_parse_cache().
+    To be called by processes when they finish.
+    """
+    if parseCacheDir is None or not parsedTemplates:
+        return
+    with open(os.path.join(parseCacheDir, 'parsed%d' % os.getpid()), 'ab') as file:
+        marshal.dump(list(parsedTemplates.items()), file)
+    parsedTemplates.clear()
+
+
+def update_parse_cache(filename: str) -> int:
+    """
+    Rewrite the parse cache :param filename: adding the templates parsed
+    by processes since open_parse_cache().
+    :return: the number of templates added.
+    """
+    global parseCache
+    global parseCacheDir
+
+    assert parseCacheDir is not None
+    save_parsed_templates()
+    entries: dict[str, bytes] = {}
+    if parseCache is not None:
+        for key in parseCache:
+            entries[key] = parseCache.raw(key)  # type: ignore[assignment]
+    added = 0
+    for name in os.listdir(parseCacheDir):
+        with open(os.path.join(parseCacheDir, name), 'rb') as file:
+            while True:
+                try:
+                    batch = marshal.load(file)
+                except EOFError:
+                    break
+                for key, data in batch:
+                    if key not in entries:
+                        entries[key] = data
+                        added += 1
+    if added:
+        with open(filename + '.tmp', 'wb') as file:
+            TemplateStore.write(file, entries)
+        os.replace(filename + '.tmp', filename)
+    shutil.rmtree(parseCacheDir)
+    parseCacheDir = None
+    if parseCache is not None:
+        parseCache.close()
+        parseCache = None
+    return added
+
+
+def freeze_templates(dir: Optional[str] = None) -> None:
+    """
+    Replace the templates and redirects collected by define_template() with
+    read-only memory mapped stores, in temporary files in :param dir:.
+    To be called before spawning processes.
+    """
+    global templates
+    global redirects
+    global rawTemplates
+
+    templates = TemplateStore.freeze(templates, dir)
+    redirects = TemplateStore.freeze(redirects, dir)
+    rawTemplates = TemplateStore.freeze(rawTemplates, dir)
+
+
+def fold_constant_templates(dir: Optional[str] = None) -> int:
+    """
+    Expand the templates that use no parameters and whose expansion does not
+    depend on the page, so that expandTemplate() returns their text, charging
+    the budgets of the page as expanding them would.
+    The expansions are stored in a memory mapped store in :param dir:.
+    To be called after loading templates and before spawning processes.
+    :return: the number of templates folded.
+    """
+    global foldedTemplates
+
+    folded: dict[str, str] = {}
+    extractor = Extractor('', '', '', '', '', [])
+    extractor.set_magic_words()
+    for title in chain(templates, rawTemplates):
+        body = templates.get(title)
+        if body is None:
+            body = template_body(rawTemplates[title])
+        if '{{{' in body:
+            continue            # it may use parameters
+        # as expanded by expandTemplate() within a page
+        extractor.frame = [(title, {})]
+        extractor.frame_depth = 1
+        extractor.depends_on_page = False
+        extractor.expansion_nodes = 0
+        if Extractor.expansionTimeout:
+            extractor.expansion_deadline = time.monotonic() + Extractor.expansionTimeout
+        try:
+            text = extractor.expandTemplates(body)
+        except ExpansionBudgetExceeded:
+            continue
+        if not extractor.depends_on_page:
+            folded[title] = '%d %d\n%s' % (extractor.expansion_nodes, extractor.frame_depth, text)
+    foldedTemplates = TemplateStore.freeze(folded, dir)
+    # not inherited by processes
+    resolvedTitles.clear()
+    templateCache.clear()
+    expansionCache.clear()
+    cache_stats(reset=True)
+    return len(folded)
+
+
+def save_templates(filename: str, info: dict[str, Any]) -> None:
+    """
+    Save the templates and redirects collected by define_template() to the
+    template cache :param filename:, with :param info: on their source.
+    Templates defined lazily are processed now.
+    """
+    processed = dict(templates)
+    for title, raw in rawTemplates.items():
+        text = template_body(raw)
+        if text:
+            processed[title] = text
+    TemplateCache.write(filename, info, processed, redirects)
+
+
+def use_templates(cache: TemplateCache) -> None:
+    """
+    Use the templates and redirects of :param cache:, instead of those
+    collected by define_template(), including those defined lazily.
+    """
+    global templates
+    global redirects
+    global rawTemplates
+
+    templates = cache.templates
+    redirects = cache.redirects
+    rawTemplates = {}
+
+
+def define_template(title: str, page: list[str], lazy: bool = False) -> None:
     """
     Adds a template defined in the :param page:.
+    :param lazy: whether to delay processing its body until it is used.
     @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
     """
     global templates
@@ -1849,12 +2789,40 @@ def define_template(title: str, page: list[str]) -> None:
     # title = normalizeTitle(title)
 
     # check for redirects
-    m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', page[0], re.IGNORECASE)
+    m = reTemplateRedirect.match(page[0])
     if m:
+        assert isinstance(redirects, dict), "templates are frozen"
         redirects[title] = m.group(1)  # normalizeTitle(m.group(1))
         return
 
-    text = unescape(''.join(page))
+    if lazy:
+        assert isinstance(rawTemplates, dict), "templates are frozen"
+        text = ''.join(page)
+        if title in rawTemplates and rawTemplates[title] != text:
+            logging.warn('Redefining: %s', title)
+        rawTemplates[title] = text
+        return
+
+    add_template(title, template_body(''.join(page)))
+
+
+def add_template(title: str, text: str) -> None:
+    """
+    Adds a template whose body, processed by template_body(), is :param text:.
+    """
+    if text:
+        assert isinstance(templates, dict), "templates are frozen"
+        if title in templates and templates[title] != text:
+            logging.warn('Redefining: %s', title)
+        templates[title] = text
+
+
+def template_body(page: str) -> str:
+    """
+    :param page: the text of a template page, as in the dump.
+    :return: the text to include where the template is used.
+    """
+    text = unescape(page)
 
     # We're storing template text for future inclusion, therefore,
     # remove all <noinclude> text and keep all <includeonly> text
@@ -1882,7 +2850,4 @@ def define_template(title: str, page: list[str]) -> None:
     else:
         text = reIncludeonly.sub('', text)
 
-    if text:
-        if title in templates and templates[title] != text:
-            logging.warn('Redefining: %s', title)
-        templates[title] = text
+    return text
@@ -28,9 +28,10 @@ Extracts a single page from a Wikipedia dump file.
 """
 
 import sys, os.path
-import re
 import argparse
-import bz2
+
+from .tokenizer import iter_pages
+from .WikiExtractor import decode_open
 
 
 # Program version
@@ -39,10 +40,6 @@ __version__ = '3.0.5'
 # ----------------------------------------------------------------------
 # READER
 
-tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
-#tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>([^<]*)')
-#                    1     2            3
-
 def process_data(input_file, id, templates=False):
     """
     :param input_file: name of the wikipedia dump file.
@@ -50,50 +47,15 @@ def process_data(input_file, id, templates=False):
     :param templates: whether article is a template.
     """
 
-    if input_file.lower().endswith(".bz2"):
-        input = bz2.open(input_file, mode='rt', encoding='utf-8')
-    else:
-        input = open(input_file)
+    input = decode_open(input_file)
 
-    page = []
-    for line in input:
-        line = line
-        if '<' not in line:         # faster than doing re.search()
-            if page:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-            page.append(line)
-            inArticle = False
-        elif tag == 'id':
-            curid = m.group(3)
-            if id == curid:
-                page.append(line)
-                inArticle = True
-            elif not inArticle and not templates:
-                page = []
-        elif tag == 'title':
-            if templates:
-                if m.group(3).startswith('Template:'):
-                    page.append(line)
-                else:
-                    page = []
-            else:
-                page.append(line)
-        elif tag == '/page':
-            if page:
-                page.append(line)
-                print(''.join(page))
-                if not templates:
-                    break
-            page = []
-        elif page:
-            page.append(line)
+    for page in iter_pages(input, raw=True):
+        if templates:
+            if page.title.startswith('Template:'):
+                print(''.join(page.lines))
+        elif page.id == id:
+            print(''.join(page.lines))
+            break
 
     input.close()
 
@@ -6,7 +6,8 @@ from typing import Iterator
 import html
 
 from .extract import acceptedNamespaces
-from .WikiExtractor import decode_open, redirect_patterns, tagRE
+from .tokenizer import iter_pages
+from .WikiExtractor import decode_open, redirect_patterns
 
 FORMAT = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT)
@@ -22,71 +23,14 @@ def collect_revisions(input_file: str) -> Iterator[tuple[str, str, str, str, str
     """
     :param text: the text of a wikipedia file dump.
     """
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
     input = decode_open(input_file)
 
-    id = ''
-    revid = ''
-    namespace = ''
-    timestamp = ''
     last_revid = ''
-    comment = ''
-    page = []
-    inText = False
-    for line in input:
-        assert isinstance(line, str), "Input must be a text file"
-        if '<' not in line:     # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            pass
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'ns':
-            namespace = m.group(3)
-        elif tag == 'id' and not id:
-            id = m.group(3)
-        elif tag == 'id' and id and not revid: # <revision> <id></id> </revision>
-            revid = m.group(3)
-        elif tag == 'redirect':
-            pass
-        elif tag == 'timestamp':
-            timestamp = m.group(3)
-        elif tag == 'comment':
-            comment = m.group(3)
-        elif tag == 'revision':
-            pass
-        elif tag == '/revision':
-            colon = title.find(':')
-            if (namespace == '0' or title[:colon] in acceptedNamespaces) and last_revid != revid:
-                yield id, revid, timestamp, title, comment, page
-                last_revid = revid
-            revid = ''
-            timestamp = ''
-            comment = ''
-            page = []
-        elif tag == '/page':
-            id = ''
-            namespace = ''
-        else:
-            if tag == 'text':
-                inText = True
-                line = line[m.start(3):m.end(3)]
-                page.append(line)
-                if m.lastindex == 4:  # open-close
-                    inText = False
-            elif tag == '/text':
-                if m.group(1):
-                    page.append(m.group(1))
-                inText = False
-            elif inText:
-                page.append(line)
+    for id, revid, timestamp, title, namespace, comment, page, _ in iter_pages(input, revisions=True):
+        colon = title.find(':')
+        if (namespace == '0' or title[:colon] in acceptedNamespaces) and last_revid != revid:
+            yield id, revid, timestamp, title, comment, page
+            last_revid = revid
     input.close()
 
 
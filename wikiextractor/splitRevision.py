@@ -5,7 +5,8 @@ from datetime import datetime
 from typing import Any, Iterator
 
 from .extract import acceptedNamespaces
-from .WikiExtractor import decode_open, tagRE
+from .tokenizer import iter_pages, tagRE
+from .WikiExtractor import decode_open
 
 FORMAT = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT)
@@ -54,68 +55,14 @@ def collect_pages(input_file: str, templateNamespace: str) -> Iterator[tuple[str
     """
     :param text: the text of a wikipedia file dump.
     """
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
     input = decode_open(input_file)
 
-    page = []
-    id = ''
-    revid = ''
-    namespace = ''
-    timestamp = ''
     last_revid = ''
-    inText = False
-    for line in input:
-        assert isinstance(line, str), "Input must be a text file"
-        if '<' not in line:     # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            pass
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'ns':
-            namespace = m.group(3)
-        elif tag == 'id' and not id:
-            id = m.group(3)
-        elif tag == 'redirect':
-            pass
-        elif tag == 'revision':
-            inText = True
-            page = []
-        elif tag == '/revision':
-            inText = False
-            colon = title.find(':')
-            if (namespace == '0' or title[:colon] in acceptedNamespaces + [templateNamespace]) and last_revid != revid:
-                yield id, revid, timestamp, title, page
-                last_revid = revid
-            revid = ''
-            timestamp = ''
-            page = []
-            inText = False
-        elif tag == '/page':
-            id = ''
-            namespace = ''
-        else:
-            page.append(line)
-            if tag == 'id' and id and not revid: # <revision> <id></id> </revision>
-                revid = m.group(3)
-            elif tag == 'id' and id and revid: # <contributor> <id><id> </contribution>
-                pass
-            elif tag == 'timestamp': # <revision> <id></id> </revision>
-                timestamp = m.group(3)
-            elif tag == 'text':
-                if m.lastindex == 4:  # open-close
-                    inText = False
-            elif tag == '/text':
-                pass
-            # elif inText:
-            #     page.append(line)
+    for id, revid, timestamp, title, namespace, _, _, page in iter_pages(input, revisions=True, raw=True):
+        colon = title.find(':')
+        if (namespace == '0' or title[:colon] in acceptedNamespaces + [templateNamespace]) and last_revid != revid:
+            yield id, revid, timestamp, title, page
+            last_revid = revid
     input.close()
 
 
@@ -0,0 +1,202 @@
+"""Template store:
+An immutable mapping from strings to strings, held in a memory mapped file.
+Processes forked after it is opened read it from the shared page cache,
+instead of duplicating, by touching their reference counts, the objects
+of a dict inherited from the parent.
+
+A store contains a header, an open addressing hash table, whose slots
+locate keys and values, and the UTF-8 encoded keys and values.
+
+A template cache file holds the stores of templates and of redirects,
+preceded by information on the dump they were collected from.
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from typing import IO, Any, Iterator, Mapping, Optional, Union
+
+# ----------------------------------------------------------------------
+
+# magic, version, number of slots, number of entries
+header = struct.Struct('<4sIII')
+magic = b'WXTS'
+version = 1
+
+# hash of key, offset of key from the start of the store, length of key,
+# length of value (following key). Offset 0 marks an empty slot.
+slot = struct.Struct('<IQII')
+
+
+class TemplateStore(Mapping[str, str]):
+
+    """
+    Read-only mapping stored in a memory mapped file written by write().
+    Values written as bytes are retrieved with raw().
+    """
+
+    def __init__(self, file: IO[bytes], start: int = 0) -> None:
+        """
+        :param file: the file holding the store, which may be closed,
+            or even removed, afterwards.
+        :param start: the offset of the store in :param file:.
+        """
+        self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = start
+        tag, file_version, self.slots, self.count = header.unpack_from(self.mm, start)
+        if tag != magic or file_version != version:
+            raise ValueError('not a template store, or of a different version')
+        self.mask = self.slots - 1
+
+    @staticmethod
+    def write(file: IO[bytes], mapping: Mapping[str, Union[str, bytes]]) -> None:
+        """
+        Write :param mapping: to :param file: as a store, at the current position.
+        """
+        start = file.tell()
+        slots = 1
+        while slots < 2 * len(mapping):  # load factor at most 1/2
+            slots *= 2
+        table = [(0, 0, 0, 0)] * slots
+        offset = header.size + slots * slot.size
+        file.seek(start + offset)
+        for key, value in mapping.items():
+            k = key.encode('utf-8')
+            v = value if isinstance(value, bytes) else value.encode('utf-8')
+            h = zlib.crc32(k)
+            i = h & (slots - 1)
+            while table[i][1]:
+                i = (i + 1) & (slots - 1)
+            table[i] = (h, offset, len(k), len(v))
+            file.write(k)
+            file.write(v)
+            offset += len(k) + len(v)
+        file.seek(start)
+        file.write(header.pack(magic, version, slots, len(mapping)))
+        for entry in table:
+            file.write(slot.pack(*entry))
+        file.seek(start + offset)
+        file.flush()
+
+    @classmethod
+    def freeze(cls, mapping: Mapping[str, str], dir: Optional[str] = None) -> 'TemplateStore':
+        """
+        :return: a store with the content of :param mapping:, in an anonymous
+            temporary file in :param dir:, removed when no longer mapped.
+        """
+        with tempfile.TemporaryFile(prefix='templates', dir=dir) as file:
+            cls.write(file, mapping)
+            return cls(file)
+
+    def raw(self, key: str) -> Optional[bytes]:
+        """
+        :return: the encoded value of :param key:, or None if missing.
+        """
+        k = key.encode('utf-8')
+        h = zlib.crc32(k)
+        i = h & self.mask
+        while True:
+            kh, offset, klen, vlen = slot.unpack_from(self.mm, self.start + header.size + i * slot.size)
+            if not offset:
+                return None
+            offset += self.start
+            if kh == h and klen == len(k) and self.mm[offset:offset + klen] == k:
+                return self.mm[offset + klen:offset + klen + vlen]
+            i = (i + 1) & self.mask
+
+    def _value(self, key: str) -> Optional[str]:
+        value = self.raw(key)
+        return None if value is None else value.decode('utf-8')
+
+    def __getitem__(self, key: str) -> str:
+        value = self._value(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:  # type: ignore[override]
+        value = self._value(key)
+        return default if value is None else value
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._value(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self.slots):
+            _, offset, klen, _ = slot.unpack_from(self.mm, self.start + header.size + i * slot.size)
+            if offset:
+                offset += self.start
+                yield self.mm[offset:offset + klen].decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        self.mm.close()
+
+
+# ----------------------------------------------------------------------
+# Template cache
+
+# magic, version, length of info, offsets of the templates and redirects stores
+cacheHeader = struct.Struct('<4sIIQQ')
+cacheMagic = b'WXTC'
+cacheVersion = 2
+
+
+def is_template_cache(filename: str) -> bool:
+    """
+    :return: whether :param filename: is a template cache, rather than a
+        template file in the XML format of older versions.
+    """
+    with open(filename, 'rb') as file:
+        return file.read(len(cacheMagic)) == cacheMagic
+
+
+class TemplateCache():
+
+    """
+    Template cache file, mapped in memory and read lazily.
+    """
+
+    def __init__(self, filename: str) -> None:
+        """
+        :raise ValueError: if :param filename: is not a template cache of
+            the current version.
+        """
+        with open(filename, 'rb') as file:
+            data = file.read(cacheHeader.size)
+            if len(data) < cacheHeader.size:
+                raise ValueError('not a template cache')
+            tag, file_version, info_size, templates_start, redirects_start = cacheHeader.unpack(data)
+            if tag != cacheMagic or file_version != cacheVersion:
+                raise ValueError('not a template cache, or of a different version')
+            self.info: dict[str, Any] = json.loads(file.read(info_size))
+            self.templates = TemplateStore(file, templates_start)
+            self.redirects = TemplateStore(file, redirects_start)
+
+    @staticmethod
+    def write(filename: str, info: dict[str, Any], templates: Mapping[str, str],
+              redirects: Mapping[str, str]) -> None:
+        """
+        Write a template cache with :param info:, :param templates: and
+        :param redirects: to :param filename:, replacing it atomically.
+        """
+        data = json.dumps(info, ensure_ascii=False).encode('utf-8')
+        with open(filename + '.tmp', 'wb') as file:
+            file.seek(cacheHeader.size + len(data))
+            templates_start = file.tell()
+            TemplateStore.write(file, templates)
+            redirects_start = file.tell()
+            TemplateStore.write(file, redirects)
+            file.seek(0)
+            file.write(cacheHeader.pack(cacheMagic, cacheVersion, len(data), templates_start, redirects_start))
+            file.write(data)
+        os.replace(filename + '.tmp', filename)
+
+    def close(self) -> None:
+        self.templates.close()
+        self.redirects.close()
@@ -0,0 +1,172 @@
+"""Dump tokenizer:
+Splits the XML of a Wikipedia dump into pages, or revisions, without an XML
+parser, relying on the layout of dumps, where each tag starts a new line and
+the text of a page is escaped, so that it contains no '<'.
+"""
+
+import re
+from gzip import GzipFile
+from itertools import islice
+from typing import IO, Any, Iterable, Iterator, NamedTuple, TextIO, Union, cast
+
+# ----------------------------------------------------------------------
+
+# matches a line with a tag, for reading the <siteinfo> header
+tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
+#                    1     2               3      4
+
+
+##
+# Size of the blocks read from the dump
+blockSize = 1024 * 1024
+
+
+class Page(NamedTuple):
+    """
+    A page, or a revision of a page, from a dump.
+    """
+    id: str
+    revid: str
+    timestamp: str
+    title: str
+    ns: str
+    comment: str
+    text: list[str]             # lines of text
+    lines: list[str]            # raw XML lines, if requested
+
+
+def value(xml: str, tag: str, start: int = 0, end: int = -1, last: bool = False) -> str:
+    """
+    :return: the text following the first, or :param last:, occurrence of
+        :param tag: in xml[start:end], up to the next '<', or '' if missing.
+    """
+    if end < 0:
+        end = len(xml)
+    pos = xml.rfind(tag, start, end) if last else xml.find(tag, start, end)
+    if pos < 0:
+        return ''
+    pos += len(tag)
+    stop = xml.find('<', pos, end)
+    return xml[pos:stop if stop >= 0 else end]
+
+
+def text_lines(xml: str, start: int, end: int) -> list[str]:
+    """
+    :return: the lines of the text of all <text> elements in xml[start:end].
+    """
+    lines = []
+    pos = xml.find('<text', start, end)
+    while pos >= 0:
+        gt = xml.find('>', pos, end)
+        if gt < 0:
+            break
+        if xml[pos + 5] in ' >/':
+            if xml[gt - 1] == '/':   # empty, like <text bytes="0" />
+                stop = xml.find('\n', gt, end)
+                lines.append(xml[gt + 1:stop + 1 if stop >= 0 else end])
+                pos = gt
+            else:
+                stop = xml.find('</text>', gt, end)
+                if stop < 0:
+                    stop = end
+                content = xml[gt + 1:stop]
+                lines.extend(content.splitlines(True) or [content])
+                pos = stop
+        pos = xml.find('<text', pos + 1, end)
+    return lines
+
+
+def iter_blocks(file: Union[TextIO, IO[Any], GzipFile, Iterable[str]], open_tag: str,
+                close_tag: str) -> Iterator[str]:
+    """
+    Split :param file: into blocks of lines, from the line containing
+    :param open_tag: to the line containing :param close_tag:.
+    Lines outside blocks are skipped.
+    """
+    read = getattr(file, 'read', None)
+    if read is None:
+        lines = iter(cast(Iterable[str], file))  # files have read()
+        read = lambda size: ''.join(islice(lines, 1024))  # noqa: E731
+    buffer = ''
+    pos = 0             # start of unprocessed data
+    scanned = 0         # where to resume looking for close_tag
+    while True:
+        start = buffer.find(open_tag, pos)
+        if start >= 0:
+            end = buffer.find(close_tag, max(start, scanned))
+            if end >= 0:
+                end = buffer.find('\n', end) + 1
+                if end:
+                    yield buffer[buffer.rfind('\n', 0, start) + 1:end]
+                    pos = scanned = end
+                    continue
+            scanned = max(start, len(buffer) - len(close_tag))
+        data = read(blockSize)
+        if not data:
+            if start >= 0 and buffer.find(close_tag, start) >= 0:
+                # last line without newline
+                yield buffer[buffer.rfind('\n', 0, start) + 1:]
+            return
+        # drop processed data, but keep the line where a block might begin
+        keep = max(pos, buffer.rfind('\n', 0, start if start >= 0 else len(buffer)) + 1)
+        buffer = buffer[keep:] + data
+        pos = max(pos - keep, 0)
+        scanned = max(scanned - keep, 0)
+
+
+def iter_pages(file: Union[TextIO, IO[Any], GzipFile, Iterable[str]], revisions: bool = False,
+               raw: bool = False) -> Iterator[Page]:
+    """
+    Split a dump into pages.
+    Instead of scanning it line by line, the dump is read in blocks and
+    the elements of each page are located by str.find(), relying on
+    the layout of dumps, where the text is escaped so that it contains no '<'.
+    :param file: the dump, or the rest of it following <siteinfo>.
+    :param revisions: whether to return each revision of a page separately.
+        Otherwise the text of all revisions of a page is joined, revid is
+        that of the first revision and timestamp that of the last one.
+    :param raw: whether to collect also the raw lines of each page, from
+        <page> to </page>, or of each revision, excluding <revision> and
+        </revision>.
+    """
+    for page in iter_blocks(file, '<page>', '</page>'):
+        end = len(page)
+        if not revisions:
+            # page metadata precede the text, unless there are more revisions
+            header = page.find('<text')
+            if header < 0 or page.find('<revision>', header) >= 0:
+                header = end
+            id_end = page.find('</id>', 0, header)
+            yield Page(value(page, '<id>', 0, header),
+                       value(page, '<id>', id_end, end) if id_end >= 0 else '',
+                       value(page, '<timestamp>', 0, header, last=True),
+                       value(page, '<title>', 0, header),
+                       value(page, '<ns>', 0, header),
+                       value(page, '<comment>', 0, header, last=True),
+                       text_lines(page, header if header < end else 0, end),
+                       page.splitlines(True) if raw else [])
+            continue
+        first = page.find('<revision>')
+        if first < 0:
+            first = end
+        id = value(page, '<id>', 0, first)
+        title = value(page, '<title>', 0, first)
+        ns = value(page, '<ns>', 0, first)
+        start = first
+        while start < end:
+            start = page.find('\n', start) + 1     # line after <revision>
+            stop = page.find('</revision>', start)
+            if not start or stop < 0:
+                break
+            stop = page.rfind('\n', start, stop) + 1 or start  # line of </revision>
+            yield Page(id,
+                       value(page, '<id>', start, stop),
+                       value(page, '<timestamp>', start, stop),
+                       title,
+                       ns,
+                       value(page, '<comment>', start, stop),
+                       text_lines(page, start, stop),
+                       page[start:stop].splitlines(True) if raw else [])
+            start = page.find('<revision>', stop)
+            if start < 0:
+                break